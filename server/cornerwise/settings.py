@@ -237,11 +237,15 @@ CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_BACKEND = 'django-cache'
 
 CELERYBEAT_SCHEDULE = {
-    "scrape-proposals": {
-        "task": "proposal.tasks.pull_updates",
-        # Run daily at midnight:
-        "schedule": crontab(
-            minute=0, hour=0)
+    "schedule-importers": {
+        "task": "proposal.tasks.schedule_importers",
+        # Each importer runs when it is due, according to its run_frequency:
+        "schedule": crontab(minute="*/15")
+    },
+
+    "recheck-documents": {
+        "task": "proposal.tasks.recheck_documents",
+        "schedule": crontab(minute=0, hour=3, day_of_week=6)
     },
 
     "send-notifications": {
@@ -283,6 +287,61 @@ THUMBNAIL_DIM = (300, 300)
 THUMBNAIL_PAD = None
 
 GEOCODER = "arcgis"
+# Try to match addresses to parcels before calling the geocoder:
+GEOCODE_FROM_PARCELS = True
+# Number of concurrent requests to send to the geocoder:
+GEOCODER_CONCURRENCY = 4
+# Maximum number of geocoder requests per second:
+GEOCODER_RATE = 10
+# Seconds to keep geocoder results for an address in the database:
+GEOCODE_CACHE_TTL = 60*60*24*90
+# Seconds to remember that an address could not be geocoded:
+GEOCODE_NEGATIVE_TTL = 60*60*24
+
+# Number of importers to fetch at the same time:
+IMPORTER_CONCURRENCY = 4
+# Seconds to wait for an importer to respond before giving up:
+IMPORTER_TIMEOUT = 300
+# Seconds an importer's whole response may take to arrive:
+IMPORTER_TOTAL_TIMEOUT = 60*30
+# Cases and events are parsed, validated, and saved in batches of this size:
+IMPORTER_BATCH_SIZE = 100
+# Scheduled importer runs are delayed by a random number of seconds, up to:
+IMPORTER_JITTER = 60*60
+# Seconds an importer task may run before it is stopped:
+IMPORTER_TASK_TIME_LIMIT = 60*60
+# Seconds to wait before retrying an importer that failed. The delay doubles
+# with each consecutive failure, up to the importer's run_frequency:
+IMPORTER_RETRY_DELAY = 60*30
+
+# Maximum number of concurrent requests to a host when downloading documents:
+DOCUMENT_HOST_CONCURRENCY = 2
+# Seconds to wait for a document server to respond or send data:
+DOCUMENT_DOWNLOAD_TIMEOUT = 60
+# Documents larger than this (in bytes) are not downloaded:
+DOCUMENT_MAX_SIZE = 200*1024*1024
+# Seconds a document download may take before it is stopped. Interrupted
+# downloads are resumed when the task is retried.
+DOCUMENT_DOWNLOAD_TIME_LIMIT = 60*10
+# Number of documents to check for changes at the same time:
+DOCUMENT_RECHECK_CONCURRENCY = 8
+# Seconds the weekly check for changed documents may run:
+DOCUMENT_RECHECK_TIME_LIMIT = 60*60
+
+# PDF text is extracted in ranges of this many pages:
+PDF_PAGES_PER_RANGE = 20
+# Number of page ranges of a single PDF to extract at the same time:
+PDF_EXTRACT_WORKERS = 4
+# Seconds to wait for the text of a range of pages to be extracted:
+PDF_EXTRACT_TIMEOUT = 120
+# Seconds the text extraction task for a document may run:
+PDF_EXTRACT_TIME_LIMIT = 60*10
+
+# Maximum time (in seconds) to cache proposal query responses. Cached responses
+# are also invalidated whenever proposal data changes.
+PROPOSAL_CACHE_TIMEOUT = 60*60*24
+# Value of the max-age Cache-Control directive sent with proposal map tiles:
+TILE_MAX_AGE = 60*15
 
 # Email address and name for emails:
 EMAIL_ADDRESS = "cornerwise@cornerwise.org"
@@ -0,0 +1,197 @@
+"""Geocodes addresses by matching them against the parcel table, so that
+addresses in towns with parcel data can be located without calling an external
+geocoder.
+"""
+from functools import reduce
+import operator
+import re
+
+from django.contrib.gis.db.models.functions import Centroid
+from django.contrib.gis.geos import Point
+from django.db.models import Q
+
+import site_config
+from shared.address import normalize_street
+
+from .models import Parcel
+
+
+ADDRESS_PATTERN = re.compile(
+    r"\s*(\d+)[a-z]?(?:\s*-\s*(\d+)[a-z]?)?\s+(.+)", re.I)
+NUMBER_RANGE_PATTERN = re.compile(r"(\d+)[a-z]?(?:\s*-\s*(\d+)[a-z]?)?$", re.I)
+
+
+def parse_address(address):
+    """Splits an address, optionally followed by a comma and the region, into
+    its components.
+
+    :returns: a tuple (low, high, street, region), where low and high are the
+    ends of the range of street numbers (the same if the address has a single
+    number), street is normalized, and region is the text after the first
+    comma. Returns None if the address does not start with a street number.
+    """
+    street_part, _, region = address.partition(",")
+    m = ADDRESS_PATTERN.match(street_part)
+    if not m:
+        return None
+    low, high = int(m.group(1)), int(m.group(2) or m.group(1))
+    return (min(low, high), max(low, high), normalize_street(m.group(3)),
+            region.strip())
+
+
+def number_range(address_num):
+    """Parses a parcel's address_num, which may be a range like '12-14'.
+
+    :returns: a tuple (low, high), or None
+    """
+    m = address_num and NUMBER_RANGE_PATTERN.match(address_num.strip())
+    if m:
+        low, high = int(m.group(1)), int(m.group(2) or m.group(1))
+        return min(low, high), max(low, high)
+
+
+def site_for_region(region):
+    """
+    :returns: the SiteConfig for a region name like 'Somerville, MA', or None
+    if there is no configured site for the region
+    """
+    # Ignore a trailing ZIP code:
+    region = re.sub(r"\s+\d{5}(-\d{4})?$", "", region or "")
+    return region and site_config.by_region_name(region) or None
+
+
+def town_for_region(region):
+    """
+    :returns: the MassGIS town id for a region name like 'Somerville, MA',
+    or None if there is no configured site for the region
+    """
+    config = site_for_region(region)
+    return config and config.town_id
+
+
+def best_match(low, high, candidates):
+    """
+    :param candidates: (gid, address_num, location) tuples for parcels on the
+    street, ordered by gid
+
+    :returns: the location of the parcel whose number matches the address
+    exactly, or, failing that, the first parcel with a range of numbers that
+    overlaps the address's range
+    """
+    exact = {str(low), str(high), f"{low}-{high}"}
+    overlapping = None
+    for gid, address_num, location in candidates:
+        if address_num in exact:
+            return gid, address_num, location
+        num_range = overlapping is None and number_range(address_num)
+        if num_range and num_range[0] <= high and low <= num_range[1]:
+            overlapping = (gid, address_num, location)
+    return overlapping
+
+
+class ParcelGeocoder(object):
+    """Implements the same interface as the other geocoders. Addresses that do
+    not match a parcel are passed to the `fallback` geocoder.
+    """
+    def __init__(self, fallback=None):
+        self.fallback = fallback
+
+    def __getattr__(self, name):
+        if name == "fallback":
+            raise AttributeError(name)
+        return getattr(self.fallback, name)
+
+    def __setattr__(self, name, value):
+        if name == "bounds" and self.fallback is not None:
+            self.fallback.bounds = value
+        else:
+            super().__setattr__(name, value)
+
+    def match_town(self, town_id, parsed):
+        """
+        :param parsed: a list of (low, high, street) tuples
+
+        :returns: a list of matching (gid, address_num, location) tuples or
+        None
+        """
+        q = reduce(operator.or_,
+                   (Q(full_street=street) &
+                    (Q(address_num__in=[str(low), str(high), f"{low}-{high}"]) |
+                     Q(address_num__contains="-"))
+                    for low, high, street in parsed))
+        by_street = {}
+        for gid, address_num, street, location in Parcel.objects\
+                .filter(q, town_id=town_id)\
+                .exclude(poly_type="ROW")\
+                .annotate(center=Centroid("shape"))\
+                .order_by("gid")\
+                .values_list("gid", "address_num", "full_street", "center"):
+            by_street.setdefault(street, []).append(
+                (gid, address_num, location))
+
+        return [best_match(low, high, by_street.get(street, []))
+                for low, high, street in parsed]
+
+    def match(self, addrs, region=None):
+        """Finds the parcels matching addresses, with one query for each
+        town.
+
+        :returns: a list of geocoder results or None
+        """
+        by_town, town_names = {}, {}
+        for i, addr in enumerate(addrs):
+            parsed = parse_address(addr)
+            if not parsed:
+                continue
+            low, high, street, addr_region = parsed
+            config = site_for_region(region or addr_region)
+            if config and config.town_id:
+                town_names[config.town_id] = config.region_name
+                by_town.setdefault(config.town_id, []).append(
+                    (i, (low, high, street)))
+
+        results = [None] * len(addrs)
+        for town_id, indexed in by_town.items():
+            matches = self.match_town(town_id, [p for _, p in indexed])
+            for (i, (_, _, street)), found in zip(indexed, matches):
+                if found:
+                    gid, address_num, location = found
+                    results[i] = {
+                        "location": {"lat": location.y, "lng": location.x},
+                        "formatted_name": (f"{address_num} {street.title()}, "
+                                           f"{town_names[town_id]}"),
+                        "properties": {"types": ["parcel"],
+                                       "parcel_id": gid}
+                    }
+        return results
+
+    def geocode(self, addrs, **kwargs):
+        if isinstance(addrs, str):
+            addrs = [addrs]
+        else:
+            addrs = list(addrs)
+
+        results = self.match(addrs, kwargs.get("region"))
+        misses = [i for i, result in enumerate(results) if not result]
+        if misses and self.fallback:
+            for i, result in zip(misses, self.fallback.geocode(
+                    [addrs[i] for i in misses], **kwargs)):
+                results[i] = result
+
+        return results
+
+    def reverse_geocode(self, lat, lng):
+        """Finds the address of the parcel containing the point, using the
+        spatial index on the parcel shapes. Falls back to the external
+        geocoder when there is no parcel with an address at the point.
+        """
+        found = Parcel.objects.containing(Point(lng, lat, srid=4326))\
+                              .exclude(poly_type="ROW")\
+                              .filter(address_num__isnull=False,
+                                      full_street__isnull=False)\
+                              .values_list("address_num", "full_street")\
+                              .first()
+        if found:
+            return f"{found[0]} {found[1].title()}"
+
+        return self.fallback and self.fallback.reverse_geocode(lat, lng)
@@ -0,0 +1,21 @@
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("parcel", "0005_auto_20170404_2015"),
+    ]
+
+    # The indexed expression must match parcel.models.full_address().
+    operations = [
+        TrigramExtension(),
+        migrations.RunSQL(
+            """
+            CREATE INDEX parcel_full_address_trgm_idx
+            ON parcel_parcel
+            USING gin ((address_num || ' ' || full_street) gin_trgm_ops)
+            """,
+            "DROP INDEX parcel_full_address_trgm_idx"),
+    ]
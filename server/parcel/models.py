@@ -1,11 +1,31 @@
 from django_pgviews import view as pg
 from django.contrib.gis.db import models
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db.models import F, Func
+
+
+def full_address():
+    """Expression for the normalized address of a Parcel. Matches the trigram
+    index created in migration 0006.
+    """
+    return Func(F("address_num"), F("full_street"), template="(%(expressions)s)",
+                arg_joiner=" || ' ' || ", output_field=models.TextField())
 
 
 class ParcelQuerySet(models.QuerySet):
     def containing(self, point):
         return self.filter(shape__contains=point)
 
+    def address_matches(self, normalized):
+        """Finds parcels whose normalized address contains the string
+        `normalized`, ordered by similarity.
+        """
+        return self.annotate(full_address=full_address())\
+                   .filter(full_address__contains=normalized)\
+                   .annotate(similarity=TrigramSimilarity("full_address",
+                                                          normalized))\
+                   .order_by("-similarity")
+
 
 class Parcel(models.Model):
     gid = models.AutoField(primary_key=True)
@@ -1,3 +1,64 @@
-from django.test import TestCase
+from django.contrib.gis.geos import MultiPolygon, Polygon
+from django.test import TestCase, tag
 
-# Create your tests here.
+from .geocoder import ParcelGeocoder, best_match, parse_address
+from .models import Parcel
+
+
+@tag("parcel", "geocoder")
+class ParcelGeocoderTests(TestCase):
+    def test_parse_address(self):
+        self.assertEqual(parse_address("12-14 Elm Street, Somerville, MA"),
+                         (12, 14, "ELM ST", "Somerville, MA"))
+        self.assertEqual(parse_address("240A Elm St."),
+                         (240, 240, "ELM ST", ""))
+        self.assertIsNone(parse_address("Davis Square"))
+
+    def test_best_match(self):
+        candidates = [(1, "11-15", "a"), (2, "13", "b")]
+        self.assertEqual(best_match(13, 13, candidates), (2, "13", "b"))
+        self.assertEqual(best_match(12, 12, candidates), (1, "11-15", "a"))
+        self.assertIsNone(best_match(20, 20, candidates))
+
+    def test_geocode(self):
+        square = Polygon.from_bbox((-71.1, 42.39, -71.098, 42.392))
+        Parcel.objects.create(address_num="12-14", full_street="ELM ST",
+                              town_id=274, poly_type="FEE",
+                              shape=MultiPolygon(square, srid=4326))
+
+        class StubGeocoder(object):
+            def geocode(self, addrs, **kwargs):
+                return [None for _ in addrs]
+
+        geocoder = ParcelGeocoder(StubGeocoder())
+        results = geocoder.geocode(["14 Elm Street, Somerville, MA",
+                                    "99 Elm Street, Somerville, MA",
+                                    "14 Elm Street, Boston, MA"])
+        self.assertAlmostEqual(results[0]["location"]["lat"], 42.391)
+        self.assertAlmostEqual(results[0]["location"]["lng"], -71.099)
+        self.assertEqual(results[0]["formatted_name"],
+                         "12-14 Elm St, Somerville, MA")
+        self.assertEqual(results[1:], [None, None])
+
+    def test_without_fallback(self):
+        geocoder = ParcelGeocoder(None)
+        geocoder.bounds = [42.37, -71.13, 42.42, -71.07]
+        self.assertEqual(geocoder.bounds, [42.37, -71.13, 42.42, -71.07])
+        self.assertEqual(geocoder.geocode(["99 Elm Street, Somerville, MA"]),
+                         [None])
+
+    def test_reverse_geocode(self):
+        square = Polygon.from_bbox((-71.1, 42.39, -71.098, 42.392))
+        Parcel.objects.create(address_num="93", full_street="HIGHLAND AVE",
+                              town_id=274, poly_type="FEE",
+                              shape=MultiPolygon(square, srid=4326))
+
+        class StubGeocoder(object):
+            def reverse_geocode(self, lat, lng):
+                return "1 Elsewhere St, Boston, MA"
+
+        geocoder = ParcelGeocoder(StubGeocoder())
+        self.assertEqual(geocoder.reverse_geocode(42.391, -71.099),
+                         "93 Highland Ave")
+        self.assertEqual(geocoder.reverse_geocode(42.0, -71.0),
+                         "1 Elsewhere St, Boston, MA")
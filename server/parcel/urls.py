@@ -6,6 +6,7 @@ from . import views
 app_name = "parcels"
 urlpatterns = [
     path(r"find", views.find_parcels, name="find"),
+    path(r"autocomplete", views.address_autocomplete, name="autocomplete"),
     re_path(r"^loc_id/(F_[\d_]+)$", views.parcel_with_loc_id,
             name="lookup-by-loc"),
     re_path(r"^(?P<pk>\d+)$", views.view_parcel),
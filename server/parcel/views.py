@@ -1,11 +1,15 @@
+from django.contrib.gis.db.models.functions import Centroid
 from django.contrib.gis.geos import Point
+from django.contrib.postgres.search import TrigramSimilarity
 from django.db.models import Q
+from django.db.models.functions import Upper
 from django.shortcuts import get_object_or_404, render
 
 from functools import reduce
 import json, operator, re
 
 from shared.address import normalize_number, normalize_street, split_address
+from proposal.models import Proposal
 from shared.request import make_response, ErrorResponse
 
 from .models import Parcel, Attribute
@@ -150,3 +154,45 @@ def parcel_with_loc_id(req, loc_id=None):
 
     parcel = Parcel.objects.get(loc_id=loc_id)
     return make_parcel_data(parcel, include_attributes=True)
+
+
+@make_response()
+def address_autocomplete(req):
+    """Suggest addresses that contain the `q` parameter, using the parcel and
+    proposal tables.
+    """
+    q = req.GET.get("q", "").strip()
+    if len(q) < 3:
+        raise ErrorResponse("Query must be at least 3 characters",
+                            {"param": "q"}, status=400)
+    try:
+        limit = min(int(req.GET.get("limit", 10)), 50)
+    except ValueError:
+        limit = 10
+
+    normalized = normalize_street(q)
+    parcels = Parcel.objects.address_matches(normalized)\
+                            .exclude(poly_type="ROW")\
+                            .annotate(center=Centroid("shape"))[0:limit]
+    proposals = Proposal.objects.filter(address__icontains=q)\
+                                .exclude(location__isnull=True)\
+                                .annotate(similarity=TrigramSimilarity(Upper("address"),
+                                                                       q.upper()))\
+                                .order_by("-similarity")[0:limit]
+
+    results = [{"type": "parcel",
+                "id": parcel.pk,
+                "address": parcel.full_address,
+                "location": {"lat": parcel.center.y, "lng": parcel.center.x},
+                "similarity": parcel.similarity}
+               for parcel in parcels]
+    results += [{"type": "proposal",
+                 "id": proposal.pk,
+                 "address": proposal.address,
+                 "location": {"lat": proposal.location.y,
+                              "lng": proposal.location.x},
+                 "similarity": proposal.similarity}
+                for proposal in proposals]
+    results.sort(key=lambda r: r["similarity"], reverse=True)
+
+    return {"results": results[0:limit]}
@@ -7,4 +7,6 @@ class ProposalConfig(AppConfig):
     def ready(self):
         # Register tasks with Celery:
         from . import tasks
+        # Register cache invalidation hooks:
+        from . import caching
 
@@ -0,0 +1,102 @@
+"""Caching for proposal query responses.
+
+Cached responses are keyed on a generation counter that is bumped whenever a
+Proposal or one of its related models is saved or deleted, so a write
+invalidates every cached response at once without having to find the affected
+keys.
+"""
+from datetime import datetime
+from hashlib import sha1
+import json
+
+from django.conf import settings
+from django.contrib.gis.geos import GEOSGeometry
+from django.core.cache import cache
+from django.db.models import Value
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Attribute, Document, Event, Image, Proposal
+
+
+GENERATION_KEY = "cornerwise:proposal_generation"
+# Datetimes in queries are rounded down to a multiple of this many seconds.
+# Relative time ranges (e.g., "the last 30 days") are converted to timestamps
+# that change with every request, so they must be rounded to produce keys
+# that can be reused.
+TIME_GRANULARITY = 60*15
+
+
+def generation():
+    return cache.get_or_set(GENERATION_KEY, 0, None)
+
+
+def bump_generation():
+    try:
+        return cache.incr(GENERATION_KEY)
+    except ValueError:
+        # The key has not been set or was evicted:
+        cache.set(GENERATION_KEY, 1, None)
+        return 1
+
+
+def normalize_value(v):
+    if isinstance(v, datetime):
+        stamp = v.timestamp()
+        return str(int(stamp - stamp % TIME_GRANULARITY))
+    if isinstance(v, GEOSGeometry):
+        return v.ewkt
+    if isinstance(v, Value):
+        # Includes SearchQuery:
+        return [type(v).__name__, normalize_value(v.value)]
+    if hasattr(v, "query"):
+        # Don't evaluate querysets used as subqueries:
+        return str(v.query)
+    if isinstance(v, (list, tuple)):
+        return [normalize_value(x) for x in v]
+    return str(v)
+
+
+def normalize_query_dict(query_dict):
+    """Converts the output of `build_proposal_query_dict` to a JSON-encodable
+    form that is the same for equivalent queries.
+    """
+    return sorted((k, normalize_value(v)) for k, v in query_dict.items())
+
+
+def cache_key(prefix, query_dicts, **extra):
+    """Constructs a cache key for a response that depends on the given query
+    dicts and on any additional keyword arguments (e.g., the site hostname and
+    page).
+    """
+    digest = sha1(json.dumps(
+        [[normalize_query_dict(d) for d in query_dicts],
+         sorted((k, str(v)) for k, v in extra.items())]
+    ).encode("utf-8")).hexdigest()
+
+    return f"cornerwise:{prefix}:{generation()}:{digest}"
+
+
+def get_or_compute(key, fn, timeout=None):
+    value = cache.get(key)
+    if value is None:
+        value = fn()
+        cache.set(key, value,
+                  settings.PROPOSAL_CACHE_TIMEOUT if timeout is None else timeout)
+    return value
+
+
+@receiver(post_save, sender=Proposal, dispatch_uid="proposal_cache_save")
+@receiver(post_delete, sender=Proposal, dispatch_uid="proposal_cache_delete")
+@receiver(post_save, sender=Attribute, dispatch_uid="attribute_cache_save")
+@receiver(post_delete, sender=Attribute, dispatch_uid="attribute_cache_delete")
+@receiver(post_save, sender=Document, dispatch_uid="document_cache_save")
+@receiver(post_delete, sender=Document, dispatch_uid="document_cache_delete")
+@receiver(post_save, sender=Image, dispatch_uid="image_cache_save")
+@receiver(post_delete, sender=Image, dispatch_uid="image_cache_delete")
+@receiver(post_save, sender=Event, dispatch_uid="event_cache_save")
+@receiver(post_delete, sender=Event, dispatch_uid="event_cache_delete")
+@receiver(m2m_changed, sender=Event.proposals.through,
+          dispatch_uid="event_proposals_cache_changed")
+def invalidate_hook(**kwargs):
+    bump_generation()
@@ -2,33 +2,152 @@
 Helper functions for working with Documents.
 """
 
+from django.conf import settings
+from django.contrib.postgres.search import SearchVector
 from django.core.files import File
+from django.core.files.storage import default_storage
+from django.utils.http import http_date
 
 from dateutil.parser import parse as dt_parse
+import os
 from os import path
+import shutil
 import subprocess
 from urllib import parse
 
-import requests
-
-from scripts import pdf
+from scripts import download, pdf
 from shared import files
 from utils import extension
 
-from .models import Image
+from .models import Document, DocumentPage, Image, TEXT_SEARCH_CONFIG
+
+
+client = download.DownloadClient(
+    max_per_host=settings.DOCUMENT_HOST_CONCURRENCY,
+    timeout=settings.DOCUMENT_DOWNLOAD_TIMEOUT,
+    max_size=settings.DOCUMENT_MAX_SIZE)
+
+
+def partial_path(doc):
+    "Returns the path where the document is downloaded before it is stored."
+    return path.join(settings.MEDIA_ROOT, "doc", "partial", f"{doc.pk}.part")
+
+
+def validators(doc):
+    """Returns the ETag and Last-Modified values to send when checking whether
+    a document has changed since it was downloaded.
+    """
+    last_modified = doc.last_modified or \
+        (doc.published and http_date(doc.published.timestamp())) or ""
+    return doc.etag, last_modified
+
+
+def derived_name(doc, filename):
+    """Returns the storage name of a file derived from the document, such as its
+    extracted text or thumbnail. Documents with the same contents share a
+    stored file, but each has its own derived files, so that documents being
+    processed at the same time don't write to the same files.
+    """
+    return "doc/%s/%s" % (doc.pk, filename)
+
+
+def derived_path(doc, filename):
+    "Returns the local path of a derived file, creating its directory."
+    file_path = default_storage.path(derived_name(doc, filename))
+    os.makedirs(path.dirname(file_path), exist_ok=True)
+    return file_path
+
+
+def delete_derived(doc):
+    "Deletes the document's extracted text and thumbnail, without saving."
+    if doc.fulltext:
+        doc.fulltext.delete(save=False)
+    if doc.thumbnail:
+        doc.thumbnail.delete(save=False)
+
+
+def copy_derived(doc, source_file, filename):
+    """Copies a file derived from another document to a derived file of `doc`.
+
+    :returns: the storage name of the copy, or None if there was nothing to
+    copy
+    """
+    if not source_file:
+        return None
+    try:
+        shutil.copyfile(source_file.path, derived_path(doc, filename))
+    except FileNotFoundError:
+        return None
+    return derived_name(doc, filename)
+
+
+def find_duplicate(doc, digest):
+    """Finds a processed Document, other than `doc`, whose file has the given
+    digest.
+    """
+    return Document.objects.filter(sha256=digest, processing_state="processed")\
+                           .exclude(pk=doc.pk)\
+                           .exclude(document="")\
+                           .first()
+
+
+def reuse_processed(doc, source):
+    """Makes `doc` share the stored file of `source`, a processed Document with
+    the same contents, and copies the text, pages, thumbnail, and images that
+    were extracted from it.
+    """
+    delete_derived(doc)
+    doc.sha256 = source.sha256
+    doc.document = source.document.name
+    doc.fulltext = copy_derived(doc, source.fulltext, "text.txt")
+    doc.encoding = source.encoding
+    doc.thumbnail = copy_derived(doc, source.thumbnail, "thumbnail.jpg")
+    doc.save()
+
+    doc.pages.all().delete()
+    DocumentPage.objects.bulk_create(
+        DocumentPage(document=doc, number=page.number, text=page.text)
+        for page in source.pages.all())
+    doc.pages.update(search=SearchVector("text", config=TEXT_SEARCH_CONFIG))
+
+    # Images from the source document may already belong to doc's proposal:
+    existing = [name for name in
+                doc.proposal.images.values_list("image", flat=True) if name]
+    Image.objects.bulk_create(
+        Image(proposal=doc.proposal, document=doc, image=image.image.name,
+              thumbnail=image.thumbnail.name, width=image.width,
+              height=image.height, priority=image.priority,
+              source=image.source)
+        for image in source.images.exclude(image__in=existing))
+
+
+def delete_unreferenced(name):
+    """Deletes a stored document file if no Document refers to it. Derived
+    files are not shared, and are deleted with `delete_derived`.
+    """
+    if not Document.objects.filter(document=name).exists():
+        default_storage.delete(name)
 
 
 def save_from_url(doc, url, filename_base=None):
     """
     Downloads the document at `url` and saves it locally, storing the path in
-    the given Document.
+    the given Document. Files are stored by the SHA-256 digest of their
+    contents. If the contents are identical to those of a Document that has
+    already been processed, the stored file and the results of processing are
+    reused.
 
     :param doc: a Document model
     :param url: URL string
     :param filename_base: optional subpath specifying where to save the
     document
 
-    Returns a tuple: (success, status_code, updated)
+    If the document has been downloaded before, the server is asked whether it
+    has changed with a HEAD request and a conditional GET. Interrupted
+    downloads are resumed on the next attempt.
+
+    Returns a tuple: (success, status_code, changed), where changed is True if
+    the document has new contents that should be processed
     """
     filename = path.basename(parse.urlsplit(url).path)
 
@@ -37,29 +156,54 @@ def save_from_url(doc, url, filename_base=None):
 
     exists = doc.document and path.exists(doc.document.path)
     if exists:
-        published = doc.published
-        headers = {"If-Modified-Since": published.strftime("%a, %d %b %Y %H:%M:%S GMT")}
+        etag, last_modified = validators(doc)
+        if client.head(url, etag, last_modified) is False:
+            return (True, 304, False)
     else:
-        headers = {}
+        etag = last_modified = ""
+
+    dest = partial_path(doc)
+    os.makedirs(path.dirname(dest), exist_ok=True)
+    dl = client.fetch(url, dest, etag, last_modified)
+    if dl.not_modified:
+        return (True, dl.status, False)
+    if not dl.ok:
+        return (False, dl.status, dl.reason)
+
+    try:
+        doc.etag = dl.etag[0:256]
+        doc.last_modified = dl.last_modified[0:64]
+        if exists and dl.digest == doc.sha256:
+            # Re-downloaded, but the contents are identical:
+            doc.save(update_fields=["etag", "last_modified"])
+            return (True, dl.status, False)
+
+        old_name = exists and doc.document.name
+        source = find_duplicate(doc, dl.digest)
+        if source:
+            reuse_processed(doc, source)
+        else:
+            # The text and thumbnail of the old contents are out of date:
+            delete_derived(doc)
+            doc.sha256 = dl.digest
+            with open(dest, "rb") as downloaded:
+                doc.document.save(filename, File(downloaded), save=False)
+    finally:
+        download.remove(dest)
 
-    with requests.get(url, headers=headers, stream=True) as response:
-        if response:
-            if response.status_code == 304:
-                return (True, response.status_code, False)
+    file_published = files.published_date(doc.document.path)
 
-            doc.document.save(filename, File(response.raw), save=False)
+    if file_published:
+        doc.published = file_published
+    elif dl.last_modified:
+        doc.published = dt_parse(dl.last_modified)
 
-            file_published = files.published_date(doc.document.path)
+    doc.save()
 
-            if file_published:
-                doc.published = file_published
-            elif "Last-Modified" in response.headers:
-                doc.published = dt_parse(response.headers["Last-Modified"])
+    if old_name and old_name != doc.document.name:
+        delete_unreferenced(old_name)
 
-            doc.save()
-            return (True, response.status_code, exists)
-        else:
-            return (False, response.status_code, response.reason)
+    return (True, dl.status, not source)
 
 
 def save_images(doc):
@@ -95,7 +239,7 @@ def generate_thumbnail(doc):
     if extension(doc_path) != "pdf":
         return
 
-    out_prefix = path.join(path.dirname(doc_path), "thumbnail")
+    out_prefix = derived_path(doc, "thumbnail")
 
     proc = subprocess.Popen(
         [
@@ -109,21 +253,59 @@ def generate_thumbnail(doc):
         raise Exception("Failed for document %s" % doc.pk, err)
 
     thumb_path = out_prefix + path.extsep + "jpg"
-    with open(thumb_path, "rb") as thumb_file:
-        doc.thumbnail.save("thumbnail.jpg", File(thumb_file))
+    doc.thumbnail = derived_name(doc, "thumbnail.jpg")
+    doc.save(update_fields=["thumbnail"])
 
     return thumb_path
 
 
-def extract_text(doc):
-    # Could consider storing the full extracted text of the document in
-    # the database and indexing it, rather than extracting it to a file.
-    text_path = path.join(path.dirname(doc.local_path), "text.txt")
+def split_pages(text):
+    """Splits text extracted by pdftotext into pages, which are separated by form
+    feeds.
+    """
+    pages = text.replace("\x00", "").split("\f")
+    if pages and not pages[-1].strip():
+        pages.pop()
+    return pages
+
+
+def save_pages(doc, pages=None):
+    """Stores the extracted text of each page of the document in the database,
+    where it can be searched.
+
+    :param pages: a list with the text of each page. If omitted, the pages are
+    read from the document's extracted text.
+    """
+    if pages is None:
+        pages = split_pages(doc.get_text())
+    doc.pages.all().delete()
+    DocumentPage.objects.bulk_create(
+        DocumentPage(document=doc, number=i, text=text)
+        for i, text in enumerate(pages, 1))
+    doc.pages.update(search=SearchVector("text", config=TEXT_SEARCH_CONFIG))
 
-    if files.extract_text(doc.local_path, text_path):
-        doc.fulltext = text_path
-        doc.encoding = files.encoding(doc.local_path)
-        doc.save()
-        return True
 
-    return False
+def extract_text(doc):
+    """Extracts the text of the document page by page, saving the pages to the
+    database and the full text to a file.
+    """
+    text_path = derived_path(doc, "text.txt")
+
+    pages = files.extract_pages(doc.local_path,
+                                pages_per_range=settings.PDF_PAGES_PER_RANGE,
+                                workers=settings.PDF_EXTRACT_WORKERS,
+                                timeout=settings.PDF_EXTRACT_TIMEOUT)
+    if pages is None:
+        return False
+
+    doc.encoding = files.encoding(doc.local_path)
+    with open(text_path, "w", encoding=doc.encoding, errors="replace") as out:
+        for text in pages:
+            out.write(text)
+            out.write("\f")
+
+    doc.fulltext = derived_name(doc, "text.txt")
+    # Other processing tasks may be saving the document concurrently:
+    doc.save(update_fields=["fulltext", "encoding"])
+    save_pages(doc, pages)
+    return True
@@ -0,0 +1,352 @@
+"""Batch import of cases from importers.
+
+`import_cases` does the same work as calling
+`Proposal.create_or_update_from_dict` on each case, but it looks up existing
+proposals, attributes, and documents with one query each per batch and writes
+them with bulk inserts and updates.
+"""
+from collections import defaultdict
+from hashlib import sha256
+import json
+
+from django.db import connection, transaction
+from django.db.models import Case, Q, Value, When
+from django.db.models.functions import Cast
+from django.db.models.signals import post_save
+from django.utils import dateparse, timezone
+
+from .models import (Attribute, Changeset, Document, Event,
+                     ImportFingerprint, Proposal, diff_attributes,
+                     diff_documents)
+
+
+PROPOSAL_UPDATE_FIELDS = ["case_numbers", "address", "other_addresses",
+                          "location", "summary", "description", "source",
+                          "region_name", "complete", "status", "updated",
+                          "started", "importer", "modified"]
+
+
+def bulk_update(objs, fields):
+    """Updates the given fields of already saved model instances with a single
+    query. This is equivalent to `QuerySet.bulk_update` in Django 2.2.
+
+    :param objs: a list of model instances of the same type
+    :param fields: a list of field names
+    """
+    if not objs:
+        return 0
+
+    model = type(objs[0])
+    updates = {}
+    for name in fields:
+        field = model._meta.get_field(name)
+        # Without the cast, PostgreSQL infers the type of a CASE whose
+        # results are all NULL or untyped literals as text:
+        updates[field.attname] = Cast(
+            Case(*(When(pk=obj.pk,
+                        then=Value(getattr(obj, field.attname),
+                                   output_field=field))
+                   for obj in objs),
+                 output_field=field),
+            output_field=field)
+
+    return model.objects.filter(pk__in=[obj.pk for obj in objs])\
+                        .update(**updates)
+
+
+def case_digest(case_dict):
+    return sha256(json.dumps(case_dict, sort_keys=True, default=str)\
+                  .encode("utf-8")).hexdigest()
+
+
+def filter_unchanged(case_dicts, importer):
+    """Removes cases that are identical to the version imported on a previous
+    run.
+
+    :param case_dicts: case dicts, before locations are added
+    :param importer: the Importer that produced the cases
+
+    :returns: a tuple (changed, digests), where changed is a list of the case
+    dicts that are new or have changed, and digests maps their case numbers to
+    digests that should be passed to `import_cases`
+    """
+    digests = {case_dict["case_number"]: case_digest(case_dict)
+               for case_dict in case_dicts}
+    unchanged = set(
+        ImportFingerprint.objects.filter(importer=importer,
+                                         case_number__in=list(digests))\
+        .values_list("case_number", "digest"))
+    changed = [case_dict for case_dict in case_dicts
+               if (case_dict["case_number"],
+                   digests[case_dict["case_number"]]) not in unchanged]
+
+    return changed, {case_dict["case_number"]: digests[case_dict["case_number"]]
+                     for case_dict in changed}
+
+
+def save_fingerprints(importer, proposals, digests):
+    """
+    :param proposals: a dict mapping case numbers to imported Proposals
+    :param digests: a dict mapping case numbers to digests
+    """
+    case_numbers = [n for n in proposals if n in digests]
+    ImportFingerprint.objects.filter(importer=importer,
+                                     case_number__in=case_numbers).delete()
+    ImportFingerprint.objects.bulk_create(
+        ImportFingerprint(importer=importer, case_number=case_number,
+                          proposal=proposals[case_number],
+                          digest=digests[case_number])
+        for case_number in case_numbers)
+
+
+def split_duplicates(case_dicts):
+    """Splits a list of case dicts into runs in which no case number is
+    repeated, so that each run can be imported as a batch.
+    """
+    run, seen = [], set()
+    for case_dict in case_dicts:
+        case_number = case_dict["case_number"]
+        if case_number in seen:
+            yield run
+            run, seen = [], set()
+        run.append(case_dict)
+        seen.add(case_number)
+
+    if run:
+        yield run
+
+
+def find_existing(case_dicts):
+    """Finds the proposals that match the given case dicts, either by case
+    number or by any of the proposals' alternate case numbers.
+
+    :returns: a dict mapping case numbers to Proposals
+    """
+    case_numbers = {case_dict["case_number"] for case_dict in case_dicts}
+    found = Proposal.objects.filter(
+        Q(case_number__in=case_numbers) |
+        Q(case_numbers__overlap=list(case_numbers)))
+
+    by_number = {}
+    for proposal in found:
+        for case_number in proposal.case_numbers or []:
+            by_number.setdefault(case_number, proposal)
+    # Prefer an exact match on the primary case number:
+    by_number.update((p.case_number, p) for p in found)
+
+    return by_number
+
+
+def send_post_save(instances, created):
+    """Sends the post_save signal for instances written with bulk queries, so
+    that the usual hooks (e.g., processing new documents) still run. If a
+    transaction is open, the signals are sent once it has been committed,
+    since receivers may start Celery tasks that look up the new objects.
+    """
+    instances = list(instances)
+
+    def send():
+        for instance in instances:
+            post_save.send(sender=type(instance), instance=instance,
+                           created=created, update_fields=None, raw=False,
+                           using=connection.alias)
+
+    if instances:
+        transaction.on_commit(send)
+
+
+def import_batch(case_dicts, importer=None, tz=None, digests=None):
+    existing = find_existing(case_dicts)
+    proposals, failed = [], []
+    for case_dict in case_dicts:
+        proposal = existing.get(case_dict["case_number"])
+        created = proposal is None
+        if created:
+            proposal = Proposal(case_number=case_dict["case_number"])
+        try:
+            proposal.case_numbers = case_dict.get("case_numbers", [])
+            prop_changes = proposal.update_properties(case_dict, not created,
+                                                      tz)
+        except Exception as exc:
+            failed.append((case_dict, exc))
+            continue
+        proposal.importer = importer
+        proposals.append((created, proposal, case_dict, prop_changes))
+
+    updated = [p for created, p, _, _ in proposals if not created]
+    attributes = defaultdict(dict)
+    documents = defaultdict(dict)
+    for attr in Attribute.objects.filter(proposal__in=updated):
+        attributes[attr.proposal_id][attr.handle] = attr
+    for doc in Document.objects.filter(proposal__in=updated):
+        documents[doc.proposal_id][doc.url] = doc
+
+    with transaction.atomic():
+        now = timezone.now()
+        for _, proposal, _, _ in proposals:
+            proposal.modified = now
+        Proposal.objects.bulk_create(
+            [p for created, p, _, _ in proposals if created])
+        bulk_update(updated, PROPOSAL_UPDATE_FIELDS)
+
+        new_attrs, updated_attrs, new_docs, updated_docs = [], [], [], []
+        changesets = []
+        # Events embedded in cases:
+        event_dicts, event_proposals = [], []
+        for created, proposal, case_dict, prop_changes in proposals:
+            attrs, changed_attrs, attr_changes = diff_attributes(
+                proposal, case_dict.get("attributes", []),
+                attributes[proposal.pk])
+            new_attrs.extend(attrs)
+            updated_attrs.extend(changed_attrs)
+
+            docs, changed_docs = diff_documents(
+                proposal, case_dict.get("documents", []),
+                documents[proposal.pk])
+            new_docs.extend(docs)
+            updated_docs.extend(changed_docs)
+
+            for event_dict in case_dict.get("events", []):
+                event_dicts.append(event_dict)
+                event_proposals.append(proposal)
+
+            if not created:
+                changesets.append(
+                    proposal.make_changeset(prop_changes, attr_changes))
+
+        import_events(event_dicts, importer, event_proposals)
+        Attribute.objects.bulk_create(new_attrs)
+        bulk_update(updated_attrs,
+                    ["text_value", "date_value", "published"])
+        Document.objects.bulk_create(new_docs)
+        bulk_update(updated_docs, ["tags", "title"])
+        Changeset.objects.bulk_create(changesets)
+
+        Proposal.objects.update_search_vectors(
+            pk__in=[p.pk for _, p, _, _ in proposals])
+
+        if importer and digests:
+            # Cases that were not geocoded are not fingerprinted, so that they
+            # are imported again, and geocoded, on the next run:
+            save_fingerprints(
+                importer,
+                {case_dict["case_number"]: p
+                 for _, p, case_dict, _ in proposals
+                 if case_dict.get("location")},
+                digests)
+
+    send_post_save([p for created, p, _, _ in proposals if created], True)
+    send_post_save(updated, False)
+    send_post_save(new_docs, True)
+
+    return [(created, p) for created, p, _, _ in proposals], failed
+
+
+def import_cases(case_dicts, importer=None, tz=None, digests=None):
+    """Creates or updates Proposals from a list of case dicts, as in
+    `Proposal.create_or_update_from_dict`, using a few queries per batch.
+
+    :param case_dicts: dictionaries describing proposals, with locations
+    already added
+    :param importer: the Importer that produced the cases
+    :param tz: time zone used for ambiguous dates. Defaults to the time zone
+    of each case's region.
+    :param digests: a dict mapping case numbers to digests, as returned by
+    `filter_unchanged`. The digests of the imported cases that have locations
+    are saved.
+
+    :returns: a tuple (results, failed). results is a list of (created,
+    proposal) pairs; failed is a list of (case_dict, exception) pairs for
+    cases that could not be imported because they are missing required
+    properties.
+    """
+    results, failed = [], []
+    for batch in split_duplicates(case_dicts):
+        batch_results, batch_failed = import_batch(batch, importer, tz,
+                                                   digests)
+        results.extend(batch_results)
+        failed.extend(batch_failed)
+
+    return results, failed
+
+
+def event_start(event_dict):
+    start = dateparse.parse_datetime(event_dict["start"])
+    # Naive dates are saved in the default time zone:
+    return timezone.make_aware(start) if timezone.is_naive(start) else start
+
+
+def import_events(event_dicts, importer=None, proposals=None):
+    """Creates or updates Events from a list of event dicts, as in
+    `Event.make_event`, and links them to the proposals for the case numbers
+    they list. Existing events, referenced proposals, and existing links are
+    each found with one query, and new rows are inserted in bulk.
+
+    :param event_dicts: dictionaries describing events
+    :param importer: the Importer that produced the events
+    :param proposals: an optional list of Proposals, the same length as
+    event_dicts. Each event is also linked to the corresponding proposal.
+
+    :returns: a list of Events, in the same order as event_dicts
+    """
+    if not event_dicts:
+        return []
+
+    keys = [(event_start(d), d["region_name"]) for d in event_dicts]
+    existing = {}
+    for event in Event.objects.filter(
+            date__in={date for date, _ in keys},
+            region_name__in={region for _, region in keys}).order_by("pk"):
+        existing.setdefault((event.date, event.region_name), event)
+
+    events, new_events, updated_events = [], [], []
+    for event_dict, key in zip(event_dicts, keys):
+        event = existing.get(key)
+        if not event:
+            event = Event(date=key[0], region_name=key[1],
+                          title=event_dict["title"])
+            existing[key] = event
+            new_events.append(event)
+        elif event.pk and event not in updated_events:
+            updated_events.append(event)
+        event.update_from_dict(event_dict, importer)
+        event.date = key[0]
+        events.append(event)
+
+    case_refs = {(case_number, d["region_name"])
+                 for d in event_dicts for case_number in d.get("cases", [])}
+    case_proposals = {}
+    if case_refs:
+        for pk, case_number, region_name in Proposal.objects.filter(
+                case_number__in={case_number for case_number, _ in case_refs})\
+                .values_list("pk", "case_number", "region_name"):
+            case_proposals[(case_number, region_name)] = pk
+
+    with transaction.atomic():
+        Event.objects.bulk_create(new_events)
+        bulk_update(updated_events, ["agenda_url", "minutes", "date",
+                                     "importer", "duration"])
+
+        links = set()
+        for i, (event, event_dict) in enumerate(zip(events, event_dicts)):
+            for case_number in event_dict.get("cases", []):
+                pk = case_proposals.get((case_number, event_dict["region_name"]))
+                if pk:
+                    links.add((event.pk, pk))
+            if proposals and proposals[i]:
+                links.add((event.pk, proposals[i].pk))
+
+        Link = Event.proposals.through
+        if links:
+            links -= set(Link.objects.filter(
+                event_id__in={event_id for event_id, _ in links},
+                proposal_id__in={pk for _, pk in links})\
+                                 .values_list("event_id", "proposal_id"))
+            Link.objects.bulk_create(
+                Link(event_id=event_id, proposal_id=pk)
+                for event_id, pk in links)
+
+    send_post_save(new_events, True)
+    send_post_save(updated_events, False)
+
+    return events
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.http import JsonResponse
+
+import time
+
+from proposal.models import Proposal
+from proposal.views import proposals_json
+from shared.request import encode_json, iter_json
+
+
+def cpu_time(fn, repeat):
+    start = time.process_time()
+    for _ in range(repeat):
+        fn()
+    return (time.process_time() - start) / repeat
+
+
+class Command(BaseCommand):
+    help = ("Compare the CPU time needed to encode a proposal list response "
+            "using JsonResponse and using shared.request's encoders.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("-n", "--count", type=int, default=500,
+                            help="Number of proposals to include")
+        parser.add_argument("-r", "--repeat", type=int, default=20)
+
+    def handle(self, *args, **options):
+        data = {"proposals": proposals_json(
+            Proposal.objects.all()[0:options["count"]],
+            include_images=1, include_events=True)}
+        repeat = options["repeat"]
+
+        results = [
+            ("JsonResponse", cpu_time(lambda: JsonResponse(data), repeat)),
+            ("encode_json", cpu_time(lambda: encode_json(data), repeat)),
+            ("iter_json", cpu_time(lambda: "".join(iter_json(data)), repeat)),
+        ]
+
+        self.stdout.write(
+            f"Encoding {len(data['proposals'])} proposals, "
+            f"average of {repeat} runs:\n")
+        for name, seconds in results:
+            self.stdout.write(f"{name:>14}: {seconds*1000:.2f} ms CPU\n")
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from proposal.models import Document
+from proposal import documents
+
+
+class Command(BaseCommand):
+    help = ("Store the extracted text of documents in the database, page by "
+            "page, so that it can be searched.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true",
+                            help="Reindex documents that already have pages")
+
+    def handle(self, *args, **options):
+        docs = Document.objects.exclude(fulltext__isnull=True)\
+                               .exclude(fulltext="")
+        if not options["all"]:
+            docs = docs.filter(pages__isnull=True)
+
+        count = 0
+        for doc in docs.distinct():
+            try:
+                documents.save_pages(doc)
+                count += 1
+            except OSError as err:
+                self.stderr.write(f"Could not read text for {doc}: {err}\n")
+
+        self.stdout.write(f"Indexed {count} document(s)\n")
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('proposal', '0038_document_processing_state'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='proposal',
+            index=models.Index(fields=['updated', 'id'], name='updated_id_idx'),
+        ),
+    ]
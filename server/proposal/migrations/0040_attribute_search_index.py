@@ -0,0 +1,20 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('proposal', '0039_updated_id_index'),
+    ]
+
+    # The indexed expression must match the SQL generated by
+    # SearchVector("text_value", config=TEXT_SEARCH_CONFIG).
+    operations = [
+        migrations.RunSQL(
+            """
+            CREATE INDEX attribute_text_value_search_idx
+            ON proposal_attribute
+            USING gin (to_tsvector('english'::regconfig, COALESCE(text_value, '')))
+            """,
+            "DROP INDEX attribute_text_value_search_idx"),
+    ]
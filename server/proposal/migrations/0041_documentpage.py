@@ -0,0 +1,32 @@
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('proposal', '0040_attribute_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentPage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.IntegerField(help_text='1-based page number')),
+                ('text', models.TextField()),
+                ('search', django.contrib.postgres.search.SearchVectorField(null=True)),
+                ('document', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pages', to='proposal.Document')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='documentpage',
+            unique_together={('document', 'number')},
+        ),
+        migrations.AddIndex(
+            model_name='documentpage',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search'], name='document_page_search_idx'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations, models
+from django.db.models import F, Func, OuterRef, Subquery, Value
+
+
+# Copied from proposal.models as of this migration, so that later changes to
+# the model don't change the migration:
+TEXT_SEARCH_CONFIG = "english"
+SEARCH_ATTRIBUTES = ["applicant_name", "legal_notice", "owner_name"]
+
+
+def make_search_vector(attribute_model):
+    attribute_text = attribute_model.objects\
+        .filter(proposal=OuterRef("pk"), hidden=False,
+                handle__in=SEARCH_ATTRIBUTES)\
+        .values("proposal")\
+        .annotate(text=StringAgg("text_value", " "))\
+        .values("text")
+    case_numbers = Func(F("case_numbers"), Value(" "),
+                        function="array_to_string",
+                        output_field=models.TextField())
+
+    return SearchVector("address", case_numbers, weight="A",
+                        config=TEXT_SEARCH_CONFIG) + \
+        SearchVector("summary", weight="B", config=TEXT_SEARCH_CONFIG) + \
+        SearchVector("description", weight="C", config=TEXT_SEARCH_CONFIG) + \
+        SearchVector(Subquery(attribute_text, output_field=models.TextField()),
+                     weight="D", config=TEXT_SEARCH_CONFIG)
+
+
+def set_search_vectors(apps, _):
+    Proposal = apps.get_model("proposal", "Proposal")
+    Attribute = apps.get_model("proposal", "Attribute")
+    Proposal.objects.update(search=make_search_vector(Attribute))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('proposal', '0041_documentpage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='proposal',
+            name='search',
+            field=django.contrib.postgres.search.SearchVectorField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name='proposal',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search'], name='proposal_search_idx'),
+        ),
+        migrations.RunPython(set_search_vectors, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('proposal', '0042_proposal_search'),
+    ]
+
+    # Supports icontains lookups, such as those made by the admin search and by
+    # address autocompletion, which are translated to UPPER(...) LIKE UPPER(...)
+    operations = [
+        TrigramExtension(),
+        migrations.RunSQL(
+            """
+            CREATE INDEX proposal_address_trgm_idx
+            ON proposal_proposal
+            USING gin (UPPER(address) gin_trgm_ops)
+            """,
+            "DROP INDEX proposal_address_trgm_idx"),
+        migrations.RunSQL(
+            """
+            CREATE INDEX proposal_case_number_trgm_idx
+            ON proposal_proposal
+            USING gin (UPPER(case_number) gin_trgm_ops)
+            """,
+            "DROP INDEX proposal_case_number_trgm_idx"),
+    ]
@@ -0,0 +1,27 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('proposal', '0043_address_trigram_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportFingerprint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('case_number', models.CharField(max_length=64)),
+                ('digest', models.CharField(max_length=64)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('importer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fingerprints', to='proposal.Importer')),
+                ('proposal', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='proposal.Proposal')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='importfingerprint',
+            unique_together={('importer', 'case_number')},
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('proposal', '0045_document_sha256'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='etag',
+            field=models.CharField(blank=True, default='', max_length=256),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='last_modified',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
@@ -4,13 +4,16 @@ from django.conf import settings
 from django.contrib.gis.db import models
 from django.contrib.gis.geos import Point
 from django.contrib.postgres import fields, indexes
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import SearchVector, SearchVectorField
 from django.core.validators import MinValueValidator
 from django.dispatch import receiver
-from django.db.models import Q
+from django.db.models import F, Func, OuterRef, Q, Subquery, Value
 from django.forms.models import model_to_dict
 from django.urls import reverse
 from django.utils import dateparse, timezone
 
+import io
 import json
 import pickle
 import pytz
@@ -19,7 +22,7 @@ from urllib import request
 import utils
 
 from dateutil.parser import parse as date_parse
-import jsonschema
+from jsonschema import Draft4Validator, RefResolver
 import pytz
 
 
@@ -47,6 +50,37 @@ def local_now(region_name=None):
     return tz.normalize(pytz.utc.localize(datetime.utcnow()))
 
 
+# Text search configuration used for full text queries and their indexes:
+TEXT_SEARCH_CONFIG = "english"
+
+# Values of these attributes are included in a proposal's search vector:
+SEARCH_ATTRIBUTES = ["applicant_name", "legal_notice", "owner_name"]
+
+
+def make_search_vector(attribute_model=None):
+    """Returns an expression that computes the weighted search vector for a
+    Proposal from its address, case numbers, summary, description and selected
+    attributes.
+    """
+    attribute_model = attribute_model or Attribute
+    attribute_text = attribute_model.objects\
+        .filter(proposal=OuterRef("pk"), hidden=False,
+                handle__in=SEARCH_ATTRIBUTES)\
+        .values("proposal")\
+        .annotate(text=StringAgg("text_value", " "))\
+        .values("text")
+    case_numbers = Func(F("case_numbers"), Value(" "),
+                        function="array_to_string",
+                        output_field=models.TextField())
+
+    return SearchVector("address", case_numbers, weight="A",
+                        config=TEXT_SEARCH_CONFIG) + \
+        SearchVector("summary", weight="B", config=TEXT_SEARCH_CONFIG) + \
+        SearchVector("description", weight="C", config=TEXT_SEARCH_CONFIG) + \
+        SearchVector(Subquery(attribute_text, output_field=models.TextField()),
+                     weight="D", config=TEXT_SEARCH_CONFIG)
+
+
 class ProposalManager(models.Manager):
     def latest(self):
         results = self.order_by("-created")
@@ -71,6 +105,9 @@ class ProposalManager(models.Manager):
     def for_parcel(self, parcel):
         return self.filter(location__within=parcel.shape)
 
+    def update_search_vectors(self, **filters):
+        return self.filter(**filters).update(search=make_search_vector())
+
 
 UNSET = object()
 def make_property_map():
@@ -155,11 +192,17 @@ class Proposal(models.Model):
     parcel = models.ForeignKey(
         "parcel.Parcel", related_name="proposals", null=True, on_delete=models.SET_NULL)
 
+    # Maintained by update_search_vector():
+    search = SearchVectorField(null=True)
+
     objects = ProposalManager()
 
     class Meta:
         indexes = [
-            indexes.GinIndex(fields=["case_numbers"], name="case_numbers_idx")
+            indexes.GinIndex(fields=["case_numbers"], name="case_numbers_idx"),
+            indexes.GinIndex(fields=["search"], name="proposal_search_idx"),
+            # Used for cursor pagination:
+            models.Index(fields=["updated", "id"], name="updated_id_idx"),
         ]
 
     def __str__(self):
@@ -200,13 +243,20 @@ class Proposal(models.Model):
     def document_for_field(self, field):
         return self.documents.filter(field=field)
 
-    def update_from_dict(self, p_dict, changed=True, tz: tzinfo=pytz.utc, importer=None):
-        """Updates the Proposal from the contents of a dictionary. When changed
-        is True, the update will generate a new Changeset describing the state
-        of the proposal before and after the changes from p_dict were applied.
+    def update_search_vector(self):
+        """Recalculates the proposal's search vector. Call after changing the
+        proposal or its attributes.
         """
-        if changed:
-            prop_changes = []
+        Proposal.objects.update_search_vectors(pk=self.pk)
+
+    def update_properties(self, p_dict, changed=True, tz: tzinfo=None):
+        """Sets the Proposal's fields from the contents of a dictionary, without
+        saving.
+
+        :returns: a list of dicts describing the changed properties, with
+        "name", "old", and "new" keys. The list is empty if `changed` is False.
+        """
+        prop_changes = []
 
         tz = tz or region_tz(p_dict.get("region_name"))
         first_hearing_date = forgiving_dateparse(p_dict.get("first_hearing_date"), tz)
@@ -232,7 +282,7 @@ class Proposal(models.Model):
                     if old_val and choose:
                         val = choose[0](old_val, val)
 
-                    if changed and val != val:
+                    if changed and val != old_val:
                         prop_changes.append({
                             "name": prop,
                             "new": val,
@@ -249,6 +299,21 @@ class Proposal(models.Model):
                 raise Exception("Missing required property: %s\n Reason: %s" %
                                 (prop, exc))
 
+        return prop_changes
+
+    def make_changeset(self, prop_changes, attr_changes):
+        return Changeset.from_changes(self, {
+            "properties": [ch for ch in prop_changes if ch["old"] != ch["new"]],
+            "attributes": [ch for ch in attr_changes if ch["old"] != ch["new"]]
+        })
+
+    def update_from_dict(self, p_dict, changed=True, tz: tzinfo=pytz.utc, importer=None):
+        """Updates the Proposal from the contents of a dictionary. When changed
+        is True, the update will generate a new Changeset describing the state
+        of the proposal before and after the changes from p_dict were applied.
+        """
+        prop_changes = self.update_properties(p_dict, changed, tz)
+
         self.importer = importer
         self.save()
 
@@ -259,47 +324,16 @@ class Proposal(models.Model):
         # Create associated documents:
         self.create_documents(p_dict.get("documents", []))
 
-        if changed:
-            attr_changes = []
+        new_attrs, updated_attrs, attr_changes = diff_attributes(
+            self, p_dict.get("attributes", []),
+            {attr.handle: attr for attr in self.attributes.all()})
+        for attr in new_attrs + updated_attrs:
+            attr.save()
 
-        attributes = p_dict.get("attributes", [])
-        if hasattr(attributes, "items"):
-            attributes = attributes.items()
-        for attr_name, attr_val in attributes:
-            try:
-                date_value = date_parse(attr_val)
-            except (ValueError, TypeError) as _:
-                date_value = None
-            try:
-                handle = utils.normalize(attr_name)
-                attr = self.attributes.get(handle=handle)
-                if attr.ignore_updates:
-                    continue
-                old_val = attr.text_value
-                attr.date_value = date_value
-                attr.text_value = attr_val
-                attr.published = updated
-                attr.save()
-            except Attribute.DoesNotExist:
-                self.attributes.create(
-                    name=attr_name,
-                    handle=handle,
-                    date_value=date_value,
-                    text_value=attr_val,
-                    published=updated)
-                old_val = None
-            if changed:
-                attr_changes.append({
-                    "name": attr_name,
-                    "old": old_val,
-                    "new": attr_val
-                })
+        self.update_search_vector()
 
         if changed:
-            changeset = Changeset.from_changes(self, {
-                "properties": [ch for ch in prop_changes if ch["old"] != ch["new"]],
-                "attributes": [ch for ch in attr_changes if ch["old"] != ch["new"]]
-            })
+            changeset = self.make_changeset(prop_changes, attr_changes)
             changeset.save()
             return changeset
 
@@ -331,6 +365,90 @@ class Proposal(models.Model):
                 for e_dict in (event_dicts or [])]
 
 
+def diff_attributes(proposal, attributes, existing):
+    """Compares the attributes from an imported case with a proposal's existing
+    attributes.
+
+    :param proposal: a Proposal
+    :param attributes: a list of (name, value) pairs or a dict
+    :param existing: a dict mapping handles to the proposal's Attributes.
+    Attributes are added as they are created.
+
+    :returns: a tuple (new, updated, changes), where new and updated are
+    lists of unsaved Attributes, and changes is a list of dicts with "name",
+    "old", and "new" keys
+    """
+    if hasattr(attributes, "items"):
+        attributes = attributes.items()
+
+    new, updated, changes = [], [], []
+    for attr_name, attr_val in attributes:
+        try:
+            date_value = date_parse(attr_val)
+        except (ValueError, TypeError) as _:
+            date_value = None
+        handle = utils.normalize(attr_name)
+        attr = existing.get(handle)
+        if attr:
+            if attr.ignore_updates:
+                continue
+            old_val = attr.text_value
+            attr.date_value = date_value
+            attr.text_value = attr_val
+            attr.published = proposal.updated
+            if attr.pk and attr not in updated:
+                updated.append(attr)
+        else:
+            attr = Attribute(proposal=proposal,
+                             name=attr_name,
+                             handle=handle,
+                             date_value=date_value,
+                             text_value=attr_val,
+                             published=proposal.updated)
+            existing[handle] = attr
+            new.append(attr)
+            old_val = None
+        changes.append({
+            "name": attr_name,
+            "old": old_val,
+            "new": attr_val
+        })
+
+    return new, updated, changes
+
+
+def diff_documents(proposal, docs, existing):
+    """Compares the document links from an imported case with a proposal's
+    existing documents.
+
+    :param existing: a dict mapping URLs to the proposal's Documents
+
+    :returns: a tuple (new, updated) of lists of unsaved Documents
+    """
+    new, updated = [], []
+    for doc_link in docs:
+        taglist = ",".join(doc_link.get("tags"))
+        doc = existing.get(doc_link["url"])
+        if doc:
+            if taglist:
+                doc.tags = taglist
+            if doc_link.get("title"):
+                doc.title = doc_link["title"]
+            if doc.pk and doc not in updated:
+                updated.append(doc)
+        else:
+            doc = Document(proposal=proposal,
+                           url=doc_link["url"],
+                           title=doc_link["title"],
+                           field=doc_link.get("tags", [None])[0],
+                           tags=taglist,
+                           published=proposal.updated)
+            existing[doc.url] = doc
+            new.append(doc)
+
+    return new, updated
+
+
 class Attribute(models.Model):
     """
     Arbitrary attributes associated with a particular proposal.
@@ -450,6 +568,23 @@ class Event(models.Model):
         d["timezone"] = self.tzname
         return d
 
+    def update_from_dict(self, event_dict, importer=None):
+        """Sets the event's fields from an imported event dict, without saving.
+        """
+        # TODO Perform actual processing on Event documents
+        for doc in event_dict.get("documents", []):
+            if re.search(r"\bagenda\b", doc["title"], re.I):
+                self.agenda_url = doc["url"]
+            elif re.search(r"\bminutes\b", doc["title"], re.I):
+                self.minutes = doc["url"]
+
+        self.date = dateparse.parse_datetime(event_dict["start"])
+        self.importer = importer
+
+        duration = utils.fn_chain(event_dict, "duration", utils.parse_duration)
+        if duration:
+            self.duration = duration
+
     @classmethod
     def make_event(cls, event_dict, importer=None):
         """
@@ -474,20 +609,7 @@ class Event(models.Model):
             kwargs["title"] = event_dict["title"]
             event = cls(**kwargs)
 
-        # TODO Perform actual processing on Event documents
-        for doc in event_dict.get("documents", []):
-            if re.search(r"\bagenda\b", doc["title"], re.I):
-                event.agenda_url = doc["url"]
-            elif re.search(r"\bminutes\b", doc["title"], re.I):
-                event.minutes = doc["url"]
-
-        event.date = start
-        event.importer = importer
-
-        duration = utils.fn_chain(event_dict, "duration", utils.parse_duration)
-        if duration:
-            event.duration = duration
-
+        event.update_from_dict(event_dict, importer)
         event.save()
 
         for case_number in event_dict.get("cases", []):
@@ -502,6 +624,9 @@ class Event(models.Model):
 
 
 def upload_document_to(doc, filename):
+    if doc.sha256:
+        # Documents with the same contents share a directory:
+        return "doc/sha256/%s/%s/%s" % (doc.sha256[0:2], doc.sha256, filename)
     return "doc/%s/%s" % (doc.pk, filename)
 
 
@@ -561,6 +686,12 @@ class Document(models.Model):
     encoding = models.CharField(max_length=20, default="")
     # File containing a thumbnail of the document:
     thumbnail = models.FileField(null=True, upload_to=upload_document_to)
+    # SHA-256 digest of the downloaded file:
+    sha256 = models.CharField(max_length=64, blank=True, default="",
+                              db_index=True)
+    # Validators sent by the server with the downloaded file:
+    etag = models.CharField(max_length=256, blank=True, default="")
+    last_modified = models.CharField(max_length=64, blank=True, default="")
 
     objects = DocumentQuerySet.as_manager()
 
@@ -596,15 +727,57 @@ class Document(models.Model):
     def tag_set(self):
         return set(filter(len, map(str.strip, self.tags.split(","))))
 
+    def iter_pages(self, first=1, last=None):
+        """Yields (number, text) for each page of the document's extracted
+        text, optionally limited to the pages from `first` to `last`.
+        """
+        pages = self.pages.filter(number__gte=first)
+        if last:
+            pages = pages.filter(number__lte=last)
+
+        if pages.exists():
+            yield from pages.order_by("number")\
+                            .values_list("number", "text")\
+                            .iterator()
+        elif self.fulltext and not self.pages.exists():
+            # The pages of documents processed before pages were stored in
+            # the database:
+            from .documents import split_pages
+
+            for number, text in enumerate(split_pages(self.get_text()), 1):
+                if number >= first and (not last or number <= last):
+                    yield (number, text)
+
     @property
     def line_iterator(self):
-        return (line.decode(self.encoding) for line in self.fulltext)
+        return (line for _, text in self.iter_pages()
+                for line in text.splitlines(True))
 
     @property
     def local_path(self):
         return self.document and self.document.path or ""
 
 
+class DocumentPage(models.Model):
+    """
+    The extracted text of a single page of a Document, indexed for searching.
+    """
+    document = models.ForeignKey(Document, related_name="pages",
+                                 on_delete=models.CASCADE)
+    number = models.IntegerField(help_text="1-based page number")
+    text = models.TextField()
+    search = SearchVectorField(null=True)
+
+    class Meta:
+        unique_together = (("document", "number"),)
+        indexes = [
+            indexes.GinIndex(fields=["search"], name="document_page_search_idx")
+        ]
+
+    def __str__(self):
+        return f"{self.document}, page {self.number}"
+
+
 @receiver(models.signals.post_delete, sender=Document)
 def auto_delete_document(**kwargs):
     """Signal to clean up the files associated with a document when it is deleted
@@ -612,12 +785,14 @@ def auto_delete_document(**kwargs):
 
     """
     document = kwargs["instance"]
-    if document.document:
-        document.document.delete(save=False)
     if document.thumbnail:
         document.thumbnail.delete(save=False)
     if document.fulltext:
         document.fulltext.delete(save=False)
+    # Documents with the same contents share a stored file:
+    if document.document and \
+       not Document.objects.filter(document=document.document.name).exists():
+        document.document.delete(save=False)
 
 
 def upload_image_to(doc, filename):
@@ -665,6 +840,9 @@ class Image(models.Model):
 @receiver(models.signals.post_delete, sender=Image)
 def auto_delete_image(**kwargs):
     image = kwargs["instance"]
+    if image.image and Image.objects.filter(image=image.image.name).exists():
+        # The files are shared with an image from a duplicate document.
+        return
     if image.image:
         image.image.delete(save=False)
     if image.thumbnail:
@@ -719,6 +897,30 @@ def get_importer_schema(where=settings.IMPORTER_SCHEMA):
         return json.load(u_in)
 
 
+@utils.lazy
+def get_importer_validator():
+    schema = get_importer_schema()
+    Draft4Validator.check_schema(schema)
+    return Draft4Validator(schema)
+
+
+@utils.lazy
+def get_item_validators():
+    """Compiles a validator for each type of item in an importer response.
+
+    :returns: a dict mapping keys ("cases", "events", "projects") to
+    validators
+    """
+    schema = get_importer_validator().schema
+    # The validators are shared across threads. The resolver keeps a stack of
+    # scopes, but every $ref in the schema is local to the same document, so
+    # the scope is always the same.
+    resolver = RefResolver.from_schema(schema)
+    return {key: Draft4Validator(prop["items"], resolver=resolver)
+            for key, prop in schema["properties"].items()
+            if "items" in prop}
+
+
 class Importer(models.Model):
     """Importers are created through the administrator interface. Cornerwise
     will place a GET request to the importer's URL once a day with a `when`
@@ -753,7 +955,22 @@ class Importer(models.Model):
     def validate(data, schema=None):
         """Validates data against the JSON schema for Cornerwise importers.
         """
-        return jsonschema.validate(data, schema or get_importer_schema())
+        validator = Draft4Validator(schema) if schema else \
+            get_importer_validator()
+        return validator.validate(data)
+
+    @staticmethod
+    def item_errors(key, item):
+        """Validates a single item from an importer response.
+
+        :param key: the key of the array containing the item
+        ("cases", "events", or "projects")
+
+        :returns: a list of ValidationErrors, which is empty if the item is
+        valid
+        """
+        validator = get_item_validators().get(key)
+        return list(validator.iter_errors(item)) if validator else []
 
     def __str__(self):
         return self.name
@@ -766,14 +983,53 @@ class Importer(models.Model):
         params = since and {"since": since.strftime("%Y%m%d")}
         return utils.add_params(self.url, params)
 
-    def updated_since(self, when=None):
-        with request.urlopen(self.url_for(when)) as u:
+    def updated_since(self, when=None, timeout=None):
+        with request.urlopen(self.url_for(when), timeout=timeout) as u:
             return json.load(u)
 
+    def stream_since(self, when=None, timeout=None, batch_size=None,
+                     total_timeout=None):
+        """Like `updated_since`, but parses the response incrementally.
+
+        :param timeout: seconds to wait for each read from the connection
+        :param total_timeout: if given, raise TimeoutError if the response is
+        still being read after this many seconds
+
+        :returns: a generator of (key, items) pairs, where key is "cases",
+        "events", or "projects" and items is a list of at most `batch_size`
+        dicts
+        """
+        with request.urlopen(self.url_for(when), timeout=timeout) as u:
+            if total_timeout:
+                u = io.BufferedReader(utils.DeadlineReader(u, total_timeout))
+            yield from utils.batch_items(
+                utils.iter_json_items(io.TextIOWrapper(u, encoding="utf-8")),
+                batch_size or settings.IMPORTER_BATCH_SIZE)
+
     def cases_since(self, when):
         return self.updated_since(when).get("cases", [])
 
 
+class ImportFingerprint(models.Model):
+    """Records a digest of the last version of a case that was imported, so
+    that cases that have not changed since the last run can be skipped.
+    Delete an importer's fingerprints to force its cases to be reimported.
+    """
+    importer = models.ForeignKey(Importer, on_delete=models.CASCADE,
+                                 related_name="fingerprints")
+    case_number = models.CharField(max_length=64)
+    proposal = models.ForeignKey(Proposal, on_delete=models.CASCADE,
+                                 related_name="+")
+    digest = models.CharField(max_length=64)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (("importer", "case_number"),)
+
+    def __str__(self):
+        return f"{self.case_number} ({self.importer})"
+
+
 class Layer(models.Model):
     name = models.CharField(max_length=100,
                             help_text="Name shown to users")
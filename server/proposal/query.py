@@ -1,14 +1,17 @@
-from django.db.models import Q
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connection
+from django.db.models import Count, F, FloatField, OuterRef, Q, Subquery
 from django.utils import timezone
 import calendar
-from collections import defaultdict
 from datetime import datetime, timedelta
 from functools import reduce, partial
+import json
 import re
 
 from dateutil.parser import parse as parse_date
 
-from .models import Attribute, local_now, localize_dt
+from .models import (Attribute, DocumentPage, Proposal, TEXT_SEARCH_CONFIG,
+                     local_now, localize_dt)
 from parcel.models import LotSize, LotQuantiles
 from utils import bounds_from_box, distance_from_str, point_from_str
 
@@ -52,7 +55,9 @@ def run_attributes_query(d):
     :param d: A dictionary-like object, typically something like
     request.GET.
 
-    :returns: A
+    :returns: None if there are no attribute parameters in `d`. Otherwise, a
+    queryset of the ids of Proposals that have an attribute matching each of
+    the parameters, suitable for use as a subquery.
     """
     subqueries = []
 
@@ -60,22 +65,24 @@ def run_attributes_query(d):
         if not k.startswith("attr."):
             continue
 
+        search = Q(search=SearchQuery(val, config=TEXT_SEARCH_CONFIG))
         if k == "attr.*":
-            subqueries.append(Q(text_value__search=val))
+            subqueries.append(search)
         else:
-            subqueries.append(Q(handle=k[5:], text_value__search=val))
+            subqueries.append(Q(handle=k[5:]) & search)
 
     if subqueries:
         query = reduce(Q.__or__, subqueries, Q())
-        attrs = Attribute.objects.filter(hidden=False)\
-                                 .filter(query)\
-                                 .values("proposal_id", "handle",
-                                         "text_value")
-        attr_maps = defaultdict(int)
-        for attr in attrs:
-            attr_maps[attr["proposal_id"]] += 1
-
-        return [pid for pid, c in attr_maps.items() if c == len(subqueries)]
+        # Uses the index on the text_value search vector. See migration 0040.
+        return Attribute.objects\
+                        .annotate(search=SearchVector("text_value",
+                                                      config=TEXT_SEARCH_CONFIG))\
+                        .filter(hidden=False)\
+                        .filter(query)\
+                        .values("proposal_id")\
+                        .annotate(matches=Count("pk"))\
+                        .filter(matches=len(subqueries))\
+                        .values("proposal_id")
 
 
 def month_range(dt):
@@ -147,6 +154,72 @@ query_params = {
 }
 
 
+def intersect_ids(id_queries):
+    if len(id_queries) == 1:
+        return id_queries[0]
+
+    return reduce(lambda proposals, ids: proposals.filter(pk__in=ids),
+                  id_queries, Proposal.objects.all()).values("pk")
+
+
+class PrefixSearchQuery(SearchQuery):
+    """A SearchQuery that matches words beginning with each of the search terms,
+    so that partial input (e.g., "Mai" or the start of a case number) matches.
+    """
+    def __init__(self, value, **kwargs):
+        terms = re.findall(r"[^\W_]+", value)
+        super().__init__(" & ".join(f"{term}:*" for term in terms), **kwargs)
+
+    def as_sql(self, compiler, connection):
+        sql, params = super().as_sql(compiler, connection)
+        return sql.replace("plainto_tsquery", "to_tsquery", 1), params
+
+
+def text_query(text):
+    """Returns a subquery of the ids of Proposals whose search vector matches
+    the beginnings of the words in `text`, or whose address contains `text`.
+    """
+    query = Q(address__icontains=text)
+    if re.search(r"[^\W_]", text):
+        query |= Q(search=PrefixSearchQuery(text, config=TEXT_SEARCH_CONFIG))
+
+    return Proposal.objects.filter(query).values("pk")
+
+
+def document_text_query(text):
+    """Returns a subquery of the ids of Proposals with at least one document page
+    matching the search terms in `text`.
+    """
+    query = SearchQuery(text, config=TEXT_SEARCH_CONFIG)
+    return DocumentPage.objects.filter(search=query)\
+                               .values("document__proposal_id")
+
+
+def rank_by_document_text(proposals, text):
+    """Orders the Proposal queryset by the relevance of the best matching page of
+    any of each proposal's documents to the search terms in `text`.
+    """
+    query = SearchQuery(text, config=TEXT_SEARCH_CONFIG)
+    best_rank = DocumentPage.objects\
+                            .filter(document__proposal=OuterRef("pk"),
+                                    search=query)\
+                            .annotate(rank=SearchRank(F("search"), query))\
+                            .order_by("-rank")\
+                            .values("rank")[0:1]
+    return proposals.annotate(text_rank=Subquery(best_rank,
+                                                 output_field=FloatField()))\
+                    .order_by(F("text_rank").desc(nulls_last=True))
+
+
+def rank_by_text(proposals, text):
+    """Orders the Proposal queryset by the relevance of each proposal's search
+    vector to the search terms in `text`.
+    """
+    query = PrefixSearchQuery(text, config=TEXT_SEARCH_CONFIG)
+    return proposals.annotate(text_rank=SearchRank(F("search"), query))\
+                    .order_by("-text_rank")
+
+
 def build_proposal_query_dict(d):
     """Constructs the keyword arguments to a Django ORM query from a dict passed in
     by a user, either directly from a request or from a saved query, such as a
@@ -155,7 +228,10 @@ def build_proposal_query_dict(d):
     Keys considered:
 
     - id: comma-separated Proposal pks
-    - text
+    - q: search terms, matched against the text of the proposal's documents
+    - text: search terms. Words are matched by prefix against the proposal's
+      address, case numbers, summary, description, and selected attributes,
+      and the whole string is matched against part of the address.
     - region
     - month - date string
     - start[/end] - date strings
@@ -168,27 +244,30 @@ def build_proposal_query_dict(d):
     """
     subqueries = {}
     defaults = {"status": "active"}
+    # Each of these is a list or subquery of Proposal ids. Matching proposals
+    # must be in all of them.
+    id_queries = []
 
-    ids = run_attributes_query(d)
+    attr_ids = run_attributes_query(d)
 
-    if ids is not None:
+    if attr_ids is not None:
         defaults["status"] = "all"
+        id_queries.append(attr_ids)
 
     if "id" in d:
         defaults["status"] = "all"
-        pids = re.split(r"\s*,\s*", d["id"])
-        ids = pids if ids is None else [id for id in pids if id in set(ids)]
+        id_queries.append(re.split(r"\s*,\s*", d["id"]))
 
-    if "text" in d:
-        subqueries["address__icontains"] = d["text"]
+    if d.get("q"):
+        id_queries.append(document_text_query(d["q"]))
+
+    if d.get("text"):
+        id_queries.append(text_query(d["text"]))
 
     if d.get("region"):
         regions = re.split(r"\s*;\s*", d["region"])
         subqueries["region_name__in"] = regions
 
-    if ids is not None:
-        subqueries["pk__in"] = ids
-
     (start_date, end_date) = time_query(d)
     if start_date:
         subqueries["started__gte"] = start_date
@@ -233,6 +312,9 @@ def build_proposal_query_dict(d):
         if k in query_params:
             subqueries[query_params[k]] = d[k]
 
+    if id_queries:
+        subqueries["pk__in"] = intersect_ids(id_queries)
+
     return subqueries
 
 
@@ -259,3 +341,18 @@ def build_event_query(d):
         subqueries["proposals__pk__in"] = d["proposal"].split(",")
 
     return Q(**subqueries)
+
+
+def approximate_count(queryset):
+    """Returns the query planner's estimate of the number of rows that the
+    queryset will return. This avoids the full scan that COUNT(*) requires, at
+    the cost of accuracy.
+    """
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Plan"]["Plan Rows"]
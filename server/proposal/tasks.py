@@ -2,16 +2,23 @@
 and their related models (Documents, Images).
 """
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from io import StringIO
 import os
 import pprint
+import queue
+import random
 import re
+import threading
+import time
 from typing import Iterable
 
 import celery
-import jsonschema
+from celery.exceptions import Ignore, SoftTimeLimitExceeded
 import pytz
+from redis.exceptions import LockError
+import requests
 
 from django.conf import settings
 from django.core.cache import cache
@@ -21,13 +28,15 @@ from django.db.models.signals import post_save
 from django.db.utils import DataError, IntegrityError
 
 from cornerwise.adapt import adapt
+import redis_utils as red
 from redis_utils import append_to_key
 from utils import add_locations, today, utc_now
 from scripts import foursquare, images, street_view, vision
+from scripts.download import DownloadTooLarge
 from shared.geocoder import Geocoder
 from shared.logger import get_logger, task_logger
 from .models import Proposal, Document, Event, Image, Importer
-from . import extract, documents as doc_utils
+from . import caching, extract, importing, documents as doc_utils
 
 
 shared_task = celery.shared_task
@@ -60,10 +69,6 @@ def document_processing_failed(task, exc, task_id, args, kwargs, einfo, ):
         doc.save()
 
 
-def document_processing_succeeded(task, retval, task_id, args, kwargs):
-    Document.objects.filter(pk=args[0]).update(processing_state="processed")
-
-
 @shared_task(bind=True)
 @adapt
 def fetch_document(self, doc: Document, logger=None):
@@ -78,14 +83,28 @@ def fetch_document(self, doc: Document, logger=None):
     url = doc.url
 
     logger.info("Fetching Document #%i", doc.pk)
-    dl, status, updated = doc_utils.save_from_url(doc, url, "download")
+    had_file = bool(doc.document)
+    try:
+        dl, status, changed = doc_utils.save_from_url(doc, url, "download")
+    except DownloadTooLarge:
+        logger.warning("Document #%i (%s) is too large to download; skipping",
+                       doc.pk, doc.url)
+        doc.processing_state = "skip"
+        doc.save(update_fields=["processing_state"])
+        raise Ignore()
+    except (requests.RequestException, SoftTimeLimitExceeded) as exc:
+        # The download will be resumed when the task is retried.
+        logger.warning("Download of Document #%i (%s) was interrupted: %s",
+                       doc.pk, doc.url, exc)
+        raise DocumentDownloadException()
     if dl:
-        if status == 304:
-            logger.info("Document #%i is up to date", doc.pk)
+        if not changed:
+            logger.info("Document #%i is up to date or duplicates a "
+                        "processed document", doc.pk)
             return (False, doc.pk)
         else:
             logger.info("Copied %s Document #%i -> %s",
-                        "updated" if updated else "new",
+                        "updated" if had_file else "new",
                         doc.pk, doc.document.path)
             return (True, doc.pk)
     else:
@@ -305,51 +324,138 @@ def save_image_text(doc: Document, image_ids, logger=task_logger):
                             for image_id in image_ids] if t]
 
     if all_text:
-        text_path = os.path.join(os.path.dirname(doc.local_path), "text.txt")
+        text_path = doc_utils.derived_path(doc, "text.txt")
         with open(text_path, "a") as fulltext:
             for text in all_text:
                 fulltext.write(text)
                 fulltext.write("\n")
         doc.encoding = "utf-8"
-        doc.fulltext = text_path
-        doc.save()
+        doc.fulltext = doc_utils.derived_name(doc, "text.txt")
+        doc.save(update_fields=["encoding", "fulltext"])
 
 
 @shared_task
-@adapt
-def post_process_images(doc: Document, image_ids, logger=task_logger):
-    logger.info(
-        f"Post processing image ids {image_ids} for doc {doc.pk}")
-    for image_id in image_ids:
+def process_image(image_id, logger=task_logger):
+    """Checks an image extracted from a document with Cloud Vision, then
+    generates a thumbnail if the image was kept.
+
+    :returns: the image id
+    """
+    try:
         cloud_vision_process(image_id, logger)
-    generate_thumbnails(image_ids, logger)
-    save_image_text(doc.id, image_ids, logger)
+        generate_thumbnail(image_id, logger=logger)
+    except Image.DoesNotExist:
+        logger.info("Image #%i was deleted during processing", image_id)
+
+    return image_id
+
+
+@shared_task(bind=True, soft_time_limit=settings.PDF_EXTRACT_TIME_LIMIT)
+@adapt
+def process_text(self, doc: Document, updated=True):
+    """Extracts the text of the document, unless it is unchanged and its text
+    has already been extracted, then updates the proposal with attributes found
+    in the text.
+    """
+    logger = get_logger(self)
+    extracted = (not updated and doc.fulltext) or extract_text(doc, logger)
+    if extracted:
+        add_doc_attributes(doc, logger)
+
+    return bool(extracted)
+
+
+@shared_task(bind=True)
+@adapt
+def process_images(self, results, doc: Document, extracted=True):
+    """Runs when the text, image extraction and thumbnail branches of the
+    document processing graph have finished. Starts a chord that processes
+    each extracted image in a separate task and then finishes processing the
+    document. The chord is only built once the image ids are known, since
+    replacing a task in a chord's header is not reliably counted by Celery 4.
+
+    :param results: a list with the result of the `process_text` branch,
+    followed by the image ids from `extract_images` if `extracted` is True,
+    and the results of any other branches
+
+    :returns: the id of the task that will complete processing
+    """
+    logger = get_logger(self)
+    image_ids = results[1] if extracted else []
+
+    finish = finish_document_processing.s(doc.pk)
+    finish.link_error(document_graph_failed.si(doc.pk))
+    if not image_ids:
+        return finish.apply_async(([],)).id
+
+    logger.info("Processing %i image(s): %s", len(image_ids), image_ids)
+    return celery.chord([process_image.si(image_id) for image_id in image_ids],
+                        finish).apply_async().id
+
+
+@shared_task(bind=True)
+@adapt
+def finish_document_processing(self, image_ids, doc: Document):
+    """Runs when all the branches of the document processing graph and the
+    processing of the extracted images have finished.
+
+    :param image_ids: the ids of the processed images
+    """
+    logger = get_logger(self)
+    save_image_text(doc, image_ids, logger)
+
+    doc.processing_state = "processed"
+    doc.save(update_fields=["processing_state"])
+    logger.info("Finished processing Document #%i", doc.pk)
+
+
+@shared_task
+def document_graph_failed(doc_id, logger=task_logger):
+    logger.warning("Processing for Document #%i failed", doc_id)
+    Document.objects.filter(pk=doc_id).update(processing_state="failed")
+    caching.bump_generation()
+
+
+def document_graph(doc, updated):
+    """Builds the Celery canvas that processes a downloaded document. Text
+    extraction, image extraction and the document thumbnail run in parallel.
+    Then each extracted image is processed by a separate task (see
+    `process_images`).
 
-    return image_ids
+    :param doc: a Document that has been copied to the local filesystem
+    :param updated: True if the document is new or has changed since it was
+    last processed
+    """
+    extract = updated or not doc.images.exists()
+    header = [process_text.si(doc.pk, updated)]
+    if extract:
+        header.append(extract_images.si(doc.pk))
+    if updated or not doc.thumbnail:
+        header.append(generate_doc_thumbnail.si(doc.pk))
+
+    body = process_images.s(doc.pk, extract)
+    body.link_error(document_graph_failed.si(doc.pk))
+
+    return celery.chord(header, body)
 
 
 @shared_task(autoretry_for=(DocumentDownloadException,),
              default_retry_delay=60*60,
              max_retries=3,
              on_failure=document_processing_failed,
-             on_success=document_processing_succeeded,
+             soft_time_limit=settings.DOCUMENT_DOWNLOAD_TIME_LIMIT,
              bind=True)
 @adapt
 def process_document(self, doc: Document):
+    """Downloads the document, then starts the tasks that process it. Download
+    failures are retried; see `document_processing_failed`.
+
+    :returns: the id of the task that will process the document's images
+    """
     logger = get_logger(self)
     updated, _ = fetch_document(doc, logger)
 
-    extracted = (not updated and doc.fulltext) or \
-        extract_text(doc, logger)
-
-    if extracted:
-        add_doc_attributes(doc, logger)
-
-        image_ids = extract_images(doc, logger)
-        post_process_images(doc, image_ids, logger)
-
-    if updated or not doc.thumbnail:
-        generate_doc_thumbnail(doc, logger)
+    return document_graph(doc, updated).apply_async().id
 
 
 def process_proposal(proposal, logger=task_logger):
@@ -372,6 +478,18 @@ def add_new_locations(cases):
     pass
 
 
+def record_import_error(case_dict, imp, exc, logger=task_logger):
+    buff = StringIO()
+    pprint.pprint(case_dict, buff)
+    buff.seek(0)
+    logger.error("Could not create proposal from dictionary: %s",
+                 buff.read(), exc_info=exc)
+    append_to_key(
+        f"cornerwise:importer:{imp.pk}:import_errors",
+        {"when": utc_now(), "dict": case_dict, "message": str(exc)},
+        limit=100)
+
+
 def create_proposal(case_dict, imp, logger=task_logger):
     """Helper function to create new Proposal objects.
     """
@@ -379,22 +497,56 @@ def create_proposal(case_dict, imp, logger=task_logger):
         (_, p) = Proposal.create_or_update_from_dict(case_dict, importer=imp)
         return p
     except Exception as exc:
-        buff = StringIO()
-        pprint.pprint(case_dict, buff)
-        buff.seek(0)
-        logger.exception("Could not create proposal from dictionary: %s",
-                         buff.read())
-        append_to_key(
-            f"cornerwise:importer:{imp.pk}:import_errors",
-            {"when": utc_now(), "dict": case_dict, "message": str(exc)},
-            limit=100)
+        record_import_error(case_dict, imp, exc, logger)
         return None
 
 
+def create_proposals(case_dicts, imp, logger=task_logger, digests=None):
+    """Batch version of `create_proposal`. If the batch cannot be written, falls
+    back to importing the cases one at a time, so that one bad case does not
+    prevent the others from being imported.
+
+    :param digests: passed to `importing.import_cases`
+
+    :returns: a tuple (pks, error_counts), as in `create_models`
+    """
+    try:
+        results, failed = importing.import_cases(case_dicts, imp,
+                                                 digests=digests)
+    except Exception as exc:
+        logger.warning("Batch import failed for importer %s; "
+                       "importing cases individually", imp, exc_info=exc)
+        return create_models(create_proposal,
+                             [(imp, case_dict) for case_dict in case_dicts],
+                             logger)
+
+    for case_dict, exc in failed:
+        record_import_error(case_dict, imp, exc, logger)
+
+    return ([p.id for _, p in results],
+            {imp: len(failed)} if failed else {})
+
+
 def create_event(event_dict, imp, logger=task_logger):
     return Event.make_event(event_dict, imp)
 
 
+def create_events(event_dicts, imp, logger=task_logger):
+    """Batch version of `create_event`. Falls back to creating the events one at
+    a time if the batch fails.
+
+    :returns: a tuple (pks, error_counts), as in `create_models`
+    """
+    try:
+        return [e.pk for e in importing.import_events(event_dicts, imp)], {}
+    except Exception as exc:
+        logger.warning("Batch import of events failed for importer %s; "
+                       "importing events individually", imp, exc_info=exc)
+        return create_models(create_event,
+                             [(imp, event_dict) for event_dict in event_dicts],
+                             logger)
+
+
 def create_models(fn, tuples, logger=task_logger):
     error_counts = defaultdict(int)
     pks = []
@@ -411,11 +563,117 @@ def create_project(project_dict, imp, logger=task_logger):
     pass
 
 
+def importer_since(importer, since, default_since):
+    """Determine the start date to use when running an importer, localized to
+    the importer's time zone.
+    """
+    if not since:
+        since = importer.last_run or default_since
+
+    return importer.tz.normalize(since) if since.tzinfo \
+        else importer.tz.localize(since)
+
+
+def quarantine_item(item, imp, errors, logger=task_logger):
+    """Records an item that failed validation in the importer's error list, so
+    that it can be reviewed in the admin.
+    """
+    message = "\n".join(
+        f"{'/'.join(map(str, err.absolute_path)) or '(root)'}: {err.message}"
+        for err in errors)
+    logger.warning("Importer %s returned an invalid item:\n%s", imp, message)
+    append_to_key(
+        f"cornerwise:importer:{imp.pk}:import_errors",
+        {"when": utc_now(), "dict": item, "message": message},
+        limit=100)
+
+
+def stream_importer(importer, since, batches, cancelled, logger=task_logger):
+    """Runs in a worker thread. Parses and validates the importer's response
+    incrementally, putting (importer, key, items) tuples on the `batches`
+    queue. Invalid items are quarantined. When finished, puts (importer, None,
+    err), where `err` is None if the importer succeeded. Makes no database
+    queries.
+    """
+    def put(message):
+        while not cancelled.is_set():
+            try:
+                batches.put(message, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    err = None
+    item_count, invalid_count, validation_time = 0, 0, 0
+    try:
+        for key, items in importer.stream_since(
+                since, timeout=settings.IMPORTER_TIMEOUT,
+                total_timeout=settings.IMPORTER_TOTAL_TIMEOUT):
+            start = time.monotonic()
+            valid = []
+            for item in items:
+                errors = importer.item_errors(key, item)
+                if errors:
+                    quarantine_item(item, importer, errors, logger)
+                    invalid_count += 1
+                else:
+                    valid.append(item)
+            validation_time += time.monotonic() - start
+            item_count += len(items)
+
+            if valid and not put((importer, key, valid)):
+                return
+    except Exception as exc:
+        err = exc
+
+    logger.info("Validated %i item(s) from %s in %.3fs; %i invalid",
+                item_count, importer, validation_time, invalid_count)
+    put((importer, None, err))
+
+
+def fetch_all(importers, since, default_since, logger=task_logger):
+    """Fetch the results of all the given importers concurrently. The queue of
+    parsed batches is bounded, so at most a few batches are held in memory at
+    a time, however large the responses are.
+
+    :returns: a generator of (importer, key, items) tuples. When an importer
+    has finished, yields (importer, None, err), where `err` is the exception
+    that stopped the importer, or None if it succeeded.
+    """
+    batches = queue.Queue(settings.IMPORTER_CONCURRENCY * 2)
+    cancelled = threading.Event()
+    with ThreadPoolExecutor(settings.IMPORTER_CONCURRENCY) as executor:
+        for importer in importers:
+            executor.submit(stream_importer, importer,
+                            importer_since(importer, since, default_since),
+                            batches, cancelled, logger)
+
+        remaining = len(importers)
+        try:
+            while remaining:
+                importer, key, payload = batches.get()
+                if key:
+                    yield importer, key, payload
+                    continue
+
+                remaining -= 1
+                if payload:
+                    logger.error("An unknown error occurred while running importer %s",
+                                 importer.name, exc_info=payload)
+                yield importer, None, payload
+        finally:
+            cancelled.set()
+
+
 @adapt
 def fetch_proposals(since: datetime=None,
                     importers: Iterable[Importer]=None,
                     logger=task_logger):
-    """Task runs each of the importers given.
+    """Task runs each of the importers given. The importers are fetched
+    concurrently, so a slow importer does not delay the others, and cases are
+    saved in batches as they are parsed from the responses. Events are saved
+    when their importer has finished.
 
     """
     now = today()
@@ -431,53 +689,76 @@ def fetch_proposals(since: datetime=None,
     if importers is None:
         importers = Importer.objects.all()
 
-    all_found = {"cases": [], "events": [], "projects": []}
-    for importer in importers:
-        importer_since = since
-        if not since:
-            if importer.last_run:
-                importer_since = importer.last_run
-            else:
-                importer_since = default_since
+    return import_batches(
+        fetch_all(list(importers), since, default_since, logger),
+        now, Geocoder, logger)
 
-        importer_since = \
-            importer.tz.normalize(importer_since) if importer_since.tzinfo \
-            else importer.tz.localize(importer_since)
 
-        try:
-            found = importer.updated_since(importer_since)
-            importer.validate(found)
-        except jsonschema.exceptions.ValidationError as err:
-            logger.warning("Importer %s failed schema validation!\n%s",
-                           importer.name, err)
-            continue
-        except Exception as err:
-            logger.exception("An unknown error occurred while running importer %s",
-                             importer.name)
+def import_batches(batches, now, geocoder=Geocoder, logger=task_logger):
+    """Saves the cases and events produced by `fetch_all`. An importer's events
+    are held until the importer has finished, so that they can be linked to
+    cases that appear after them in the response.
+
+    :param batches: an iterable of (importer, key, items) tuples, as generated
+    by `fetch_all`
+    :param now: the time to record as the last run of each importer that
+    succeeded
+    :param geocoder: used to add locations to cases
+
+    :returns: a dict. Its "errors" value maps the ids of importers that failed
+    to error messages.
+    """
+    found = defaultdict(lambda: defaultdict(int))
+    pending_events = defaultdict(list)
+    result = {"proposal_ids": [], "event_ids": [],
+              "cases_changed": 0, "cases_skipped": 0, "errors": {}}
+
+    def log_errors(errors, type_name):
+        for imp, count in errors.items():
+            logger.warn(f"Importer {imp} was unable to import {count} {type_name}")
+
+    for importer, type_name, items in batches:
+        if not type_name:
+            # Save whatever was received before an error, but don't advance
+            # last_run, so that the importer is run again from the same point.
+            events = pending_events.pop(importer.pk, [])
+            if events:
+                ids, errors = create_events(events, importer, logger)
+                log_errors(errors, "events")
+                result["event_ids"].extend(ids)
+
+            found_description = ", ".join(
+                f"{n} {k}" for k, n in found[importer.pk].items())
+            logger.info(f"Fetched: {found_description} w/{importer}")
+
+            if items:
+                result["errors"][importer.pk] = str(items)
+            else:
+                importer.last_run = now
+                importer.save()
             continue
 
-        found_description = ", ".join(f"{len(v)} {k}" for k, v in found.items())
-        logger.info(f"Fetched: {found_description} w/{importer}")
+        found[importer.pk][type_name] += len(items)
+        if type_name not in ("cases", "events"):
+            continue
 
-        for k in found:
-            for item in found[k]:
-                item.setdefault("region_name", importer.region_name)
-                all_found[k].append((importer, item))
+        for item in items:
+            item.setdefault("region_name", importer.region_name)
 
-        importer.last_run = now
-        importer.save()
+        if type_name == "events":
+            pending_events[importer.pk].extend(items)
+            continue
 
-    add_locations([case for _, case in all_found["cases"]],
-                  Geocoder)
-    result = {}
-    for type_name, maker_fn, k in [("cases", create_proposal, "proposal_ids"),
-                                   ("events", create_event, "event_ids")]:
+        changed, digests = importing.filter_unchanged(items, importer)
+        result["cases_skipped"] += len(items) - len(changed)
+        result["cases_changed"] += len(changed)
+        if not changed:
+            continue
 
-        ids, errors = create_models(maker_fn, all_found[type_name], logger)
-        if errors:
-            for imp, count in errors.items():
-                logger.warn(f"Importer {imp} was unable to import {count} {type_name}")
-        result[k] = ids
+        add_locations(changed, geocoder)
+        ids, errors = create_proposals(changed, importer, logger, digests)
+        log_errors(errors, "cases")
+        result["proposal_ids"].extend(ids)
 
     return result
 
@@ -498,6 +779,171 @@ def pull_updates(self, since: datetime=None, importers_filter={}):
                            logger=get_logger(self))
 
 
+def importer_key(importer_id, suffix):
+    return f"cornerwise:importer:{importer_id}:{suffix}"
+
+
+def importer_state(importer_id):
+    """
+    :returns: a dict describing the last scheduled run of the importer, with
+    "state" ("queued", "running", "succeeded", or "failed"), "when", and
+    "task_id" keys, or None if the importer has not been scheduled
+    """
+    return red.get_key(importer_key(importer_id, "state"))
+
+
+def set_importer_state(importer_id, state, task_id=None, **extra):
+    red.set_key(importer_key(importer_id, "state"),
+                dict(extra, state=state, when=utc_now(), task_id=task_id))
+
+
+def importer_is_due(importer, now):
+    return not importer.last_run or \
+        importer.last_run + importer.run_frequency <= now
+
+
+def retry_delay(importer, failures):
+    """
+    :param failures: the number of consecutive failed runs of the importer
+
+    :returns: a timedelta; how long to wait after the last failed run before
+    running the importer again. The delay doubles with each failure, up to
+    the importer's run_frequency.
+    """
+    delay = timedelta(
+        seconds=settings.IMPORTER_RETRY_DELAY * 2**min(failures - 1, 16))
+    return min(delay, importer.run_frequency)
+
+
+@shared_task(bind=True,
+             soft_time_limit=settings.IMPORTER_TASK_TIME_LIMIT,
+             time_limit=settings.IMPORTER_TASK_TIME_LIMIT + 60)
+def run_importer(self, importer_id, since: datetime=None):
+    """Run a single importer. If the importer is already running, do nothing.
+    """
+    logger = get_logger(self)
+    lock = red.Redis.lock(importer_key(importer_id, "lock"),
+                          timeout=settings.IMPORTER_TASK_TIME_LIMIT + 60)
+    if not lock.acquire(blocking=False):
+        logger.info("Importer #%i is already running", importer_id)
+        return None
+
+    task_id = self.request.id
+    failures_key = importer_key(importer_id, "failures")
+    failures = red.get_key(failures_key) or 0
+    try:
+        set_importer_state(importer_id, "running", task_id)
+        result = fetch_proposals(
+            since, importers=Importer.objects.filter(pk=importer_id),
+            logger=logger)
+    except Exception as exc:
+        red.set_key(failures_key, failures + 1)
+        set_importer_state(importer_id, "failed", task_id, message=str(exc),
+                           failures=failures + 1)
+        raise
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            # The lock expired during the run, and may now be held by
+            # another task.
+            logger.warning("Lock for importer #%i expired before the run "
+                           "finished", importer_id)
+
+    if result["errors"]:
+        red.set_key(failures_key, failures + 1)
+        set_importer_state(importer_id, "failed", task_id,
+                           message=result["errors"].get(importer_id, ""),
+                           failures=failures + 1,
+                           proposals=len(result["proposal_ids"]),
+                           events=len(result["event_ids"]))
+    else:
+        red.set_key(failures_key, 0)
+        set_importer_state(importer_id, "succeeded", task_id,
+                           proposals=len(result["proposal_ids"]),
+                           events=len(result["event_ids"]))
+    return result
+
+
+@shared_task(bind=True)
+def schedule_importers(self):
+    """Enqueue a run of each importer that is due according to its
+    run_frequency. Runs are delayed by a random amount of up to
+    IMPORTER_JITTER seconds, so that they don't all start at once. Importers
+    whose last run failed are retried with an increasing delay (see
+    `retry_delay`).
+    """
+    logger = get_logger(self)
+    now = utc_now()
+    stale = now - timedelta(seconds=settings.IMPORTER_JITTER +
+                            settings.IMPORTER_TASK_TIME_LIMIT)
+    scheduled = []
+    for importer in Importer.objects.all():
+        if not importer_is_due(importer, now):
+            continue
+
+        state = importer_state(importer.pk)
+        if state and state["state"] in ("queued", "running") and \
+           state["when"] > stale:
+            continue
+
+        if state and state["state"] == "failed" and \
+           state["when"] + retry_delay(importer, state.get("failures", 1)) > now:
+            continue
+
+        delay = random.uniform(0, settings.IMPORTER_JITTER)
+        result = run_importer.apply_async((importer.pk,), countdown=delay)
+        set_importer_state(importer.pk, "queued", result.task_id)
+        logger.info("Scheduled importer %s to run in %i seconds",
+                    importer, delay)
+        scheduled.append(importer.pk)
+
+    return scheduled
+
+
+@shared_task(bind=True, soft_time_limit=settings.DOCUMENT_RECHECK_TIME_LIMIT)
+def recheck_documents(self, proposal_ids=None):
+    """Asks the servers hosting processed documents whether the documents have
+    changed, and processes the documents again if they have. The checks are
+    sent concurrently, but the download client limits the number of requests
+    sent to each host at once.
+
+    :param proposal_ids: if given, only check the documents of these
+    proposals. Defaults to the documents of incomplete proposals.
+
+    :returns: the ids of the documents that will be processed
+    """
+    logger = get_logger(self)
+    docs = Document.objects.filter(processing_state="processed")\
+                           .exclude(document="")
+    if proposal_ids:
+        docs = docs.filter(proposal__in=proposal_ids)
+    else:
+        docs = docs.filter(proposal__complete__isnull=True)
+    docs = list(docs)
+
+    def check(doc):
+        try:
+            return doc_utils.client.head(doc.url, *doc_utils.validators(doc))
+        except requests.RequestException as exc:
+            logger.warning("Could not check Document #%i (%s): %s",
+                           doc.pk, doc.url, exc)
+            return False
+
+    with ThreadPoolExecutor(settings.DOCUMENT_RECHECK_CONCURRENCY) as executor:
+        changed = [doc.pk for doc, result in zip(docs, executor.map(check, docs))
+                   # None means the server could not say, so let
+                   # process_document send a conditional request:
+                   if result is not False]
+
+    logger.info("%i of %i document(s) may have changed",
+                len(changed), len(docs))
+    for pk in changed:
+        process_document.delay(pk)
+
+    return changed
+
+
 # Image tasks
 @shared_task
 def cloud_vision_process(image_id, logger=task_logger):
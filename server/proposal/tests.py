@@ -1,15 +1,25 @@
+from base64 import urlsafe_b64encode
 import os
 from datetime import datetime, timedelta
 from pprint import pprint
 
 from django.conf import settings
-from django.test import TestCase, tag
+from django.core.files.base import ContentFile
+from django.forms.models import model_to_dict
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.test import TestCase, TransactionTestCase, override_settings, tag
+from django.urls import reverse
 
-from proposal.models import Importer, Proposal
+from cornerwise import celery_app
+from proposal.models import Event, Importer, Proposal
 from scripts import gmaps
-from utils import add_locations
+from shared import files
+from shared.request import ErrorResponse
+from utils import add_locations, utc_now
 
-from . import extract, tasks
+from . import caching, documents, extract, importing, tasks, tiles, views
+from .query import build_proposal_query_dict
 
 proposal_dict = {'all_addresses': ['21 Cherry Street'],
                  'case_number': 'ZBA 2017-123',
@@ -39,6 +49,36 @@ proposal_dict = {'all_addresses': ['21 Cherry Street'],
 proposal_dict_with_location = proposal_dict.copy()
 proposal_dict_with_location["location"] = {"lat": 42.370737, "long": -71.08638}
 
+
+def make_pdf(pages):
+    """Returns the contents of a PDF with a page for each string in `pages`."""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None,
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in pages:
+        stream = f"BT /F1 24 Tf 72 720 Td ({text}) Tj ET".encode("latin-1")
+        objects.append(b"<< /Length %i >>\nstream\n%s\nendstream" %
+                       (len(stream), stream))
+        objects.append(b"<< /Type /Page /Parent 2 0 R "
+                       b"/MediaBox [0 0 612 792] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> "
+                       b"/Contents %i 0 R >>" % len(objects))
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %i >>" % (
+        b" ".join(b"%i 0 R" % kid for kid in kids), len(kids))
+
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%i 0 obj\n%s\nendobj\n" % (number, obj)
+    xref = len(out)
+    out += b"xref\n0 %i\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010i 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %i /Root 1 0 R >>\nstartxref\n%i\n%%%%EOF\n" % (
+        len(objects) + 1, xref)
+    return out
+
 @tag("proposal", "import")
 class TestImport(TestCase):
     def setUp(self):
@@ -119,10 +159,399 @@ class TestImport(TestCase):
         self.assertIn("Applicant Name", changed_attribute_names)
         self.assertIn("description", changed_property_names)
 
+    def test_item_errors(self):
+        case = {"case_number": "ZBA 2017-1",
+                "all_addresses": ["21 Cherry Street"],
+                "updated_date": "2017-10-02T11:49:00-04:00"}
+        self.assertEqual(Importer.item_errors("cases", case), [])
+        errors = Importer.item_errors("cases", {"case_number": "ZBA 2017-1"})
+        self.assertTrue(errors)
+        self.assertTrue(all(err.validator == "required" for err in errors))
+
+    def test_import_cases(self):
+        pdict = proposal_dict_with_location.copy()
+        pdict["attributes"] = list(pdict["attributes"])
+        ((created, proposal),), failed = importing.import_cases([pdict])
+        self.assertTrue(created)
+        self.assertEqual(failed, [])
+        self.assertEqual(proposal.attribute_dict,
+                         {"Applicant Name": "Sally Bobson"})
+
+        # Matched by an alternate case number:
+        proposal.case_numbers = ["ZBA 2017-123-A"]
+        proposal.save()
+        pdict = dict(pdict, case_number="ZBA 2017-123-A",
+                     description="A new description",
+                     case_numbers=["ZBA 2017-123-A"])
+        missing = {"case_number": "ZBA 2017-999"}
+        results, failed = importing.import_cases([pdict, missing])
+        self.assertEqual(results, [(False, proposal)])
+        self.assertEqual([d for d, _ in failed], [missing])
+
+        changes = proposal.changesets.get().changes
+        self.assertIn("description",
+                      [c["name"] for c in changes["properties"]])
+
+    def test_bulk_update_nulls(self):
+        (_, proposal) = Proposal.create_or_update_from_dict(
+            proposal_dict_with_location.copy())
+        attribute = proposal.attributes.get()
+        # Every value of each updated column is NULL:
+        proposal.complete = None
+        proposal.importer = None
+        attribute.date_value = None
+        importing.bulk_update([proposal], ["complete", "importer"])
+        importing.bulk_update([attribute], ["date_value"])
+
+        proposal.refresh_from_db()
+        self.assertIsNone(proposal.complete)
+        self.assertIsNone(proposal.importer)
+
+    def test_import_events(self):
+        (_, proposal) = Proposal.create_or_update_from_dict(
+            proposal_dict_with_location.copy())
+        event_dict = {"title": "Planning Board",
+                      "region_name": "Somerville, MA",
+                      "start": "2017-06-01T18:00:00",
+                      "cases": [proposal.case_number, "ZBA 0000-000"]}
+        # Events, proposals, and links are each looked up with one query:
+        with self.assertNumQueries(7):
+            events = importing.import_events([event_dict, event_dict.copy()])
+        self.assertEqual(events[0], events[1])
+        self.assertEqual(list(events[0].proposals.all()), [proposal])
+
+        # Importing again should update the existing event:
+        self.assertEqual(importing.import_events([event_dict]), events[0:1])
+        self.assertEqual(events[0].proposals.count(), 1)
+
+    def test_reimport_events(self):
+        importer = Importer.objects.create(name="Test Importer",
+                                           region_name="Somerville, MA",
+                                           url="http://localhost/")
+        event_dict = {"title": "Planning Board",
+                      "region_name": "Somerville, MA",
+                      "start": "2017-06-01T18:00:00"}
+        [event] = importing.import_events([event_dict])
+
+        # The updated importer and duration columns are NULL for every event:
+        [updated] = importing.import_events([event_dict])
+        self.assertEqual(updated.pk, event.pk)
+        updated.refresh_from_db()
+        self.assertIsNone(updated.importer)
+        self.assertIsNone(updated.duration)
+
+        event_dict = dict(event_dict, duration="1:30", documents=[
+            {"title": "Agenda", "url": "http://localhost/agenda.pdf"}])
+        [updated] = importing.import_events([event_dict], importer)
+        updated.refresh_from_db()
+        self.assertEqual(updated.importer, importer)
+        self.assertEqual(updated.duration, timedelta(hours=1, minutes=30))
+        self.assertEqual(updated.agenda_url, "http://localhost/agenda.pdf")
+
+    def test_fingerprint_located_cases(self):
+        importer = Importer.objects.create(name="Test Importer",
+                                           region_name="Somerville, MA",
+                                           url="http://localhost/")
+        located = dict(proposal_dict_with_location,
+                       attributes=list(proposal_dict["attributes"]))
+        # An existing case whose address could not be geocoded on this run:
+        Proposal.create_or_update_from_dict(
+            dict(proposal_dict_with_location, case_number="ZBA 2017-999"))
+        unlocated = dict(proposal_dict, case_number="ZBA 2017-999",
+                         attributes=list(proposal_dict["attributes"]))
+
+        changed, digests = importing.filter_unchanged([located, unlocated],
+                                                      importer)
+        self.assertEqual(len(changed), 2)
+        results, failed = importing.import_cases(changed, importer,
+                                                 digests=digests)
+        self.assertEqual((len(results), failed), (2, []))
+
+        changed, _ = importing.filter_unchanged([located, unlocated],
+                                                importer)
+        self.assertEqual([c["case_number"] for c in changed],
+                         ["ZBA 2017-999"])
+
+    def test_events_before_cases(self):
+        class NoGeocoder(object):
+            def geocode(self, addrs):
+                return [None for _ in addrs]
+
+        importer = Importer.objects.create(name="Test Importer",
+                                           region_name="Somerville, MA",
+                                           url="http://localhost/")
+        case = dict(proposal_dict_with_location,
+                    attributes=list(proposal_dict["attributes"]), events=[])
+        event_dict = {"title": "Planning Board",
+                      "start": "2017-06-01T18:00:00",
+                      "cases": [case["case_number"]]}
+        # The response lists events before the cases they refer to:
+        result = tasks.import_batches([(importer, "events", [event_dict]),
+                                       (importer, "cases", [case]),
+                                       (importer, None, None)],
+                                      utc_now(), NoGeocoder())
+
+        self.assertEqual(len(result["event_ids"]), 1)
+        event = Event.objects.get(pk=result["event_ids"][0])
+        self.assertEqual([p.pk for p in event.proposals.all()],
+                         result["proposal_ids"])
+
+    def test_failed_importer(self):
+        importer = Importer.objects.create(name="Test Importer",
+                                           region_name="Somerville, MA",
+                                           url="http://localhost/")
+        result = tasks.import_batches(
+            [(importer, None, ValueError("Bad response"))], utc_now())
+        self.assertEqual(result["errors"], {importer.pk: "Bad response"})
+        importer.refresh_from_db()
+        self.assertIsNone(importer.last_run)
+
+        self.assertEqual(tasks.retry_delay(importer, 1),
+                         timedelta(seconds=settings.IMPORTER_RETRY_DELAY))
+        self.assertEqual(tasks.retry_delay(importer, 100),
+                         importer.run_frequency)
+
+    def tearDown(self):
+        Proposal.objects.all().delete()
+
+
+@tag("proposal", "import")
+class TestImportSignals(TransactionTestCase):
+    def test_signals_after_commit(self):
+        received = []
+
+        def on_save(sender, instance, created, **kwargs):
+            received.append((instance.pk, created))
+
+        post_save.connect(on_save, sender=Event)
+        try:
+            with transaction.atomic():
+                [event] = importing.import_events(
+                    [{"title": "Planning Board",
+                      "region_name": "Somerville, MA",
+                      "start": "2017-06-01T18:00:00"}])
+                self.assertEqual(received, [])
+        finally:
+            post_save.disconnect(on_save, sender=Event)
+
+        self.assertEqual(received, [(event.pk, True)])
+
+
+@tag("proposal", "views")
+class TestSerialization(TestCase):
+    def setUp(self):
+        for i in range(3):
+            pdict = proposal_dict_with_location.copy()
+            pdict["case_number"] = f"ZBA 2017-12{i}"
+            Proposal.create_or_update_from_dict(pdict)
+
+    def test_batch_matches_single(self):
+        def single_json(proposal, include_images):
+            # Serializes one proposal by querying its relations directly, as
+            # proposal_json did before serialization was batched.
+            pdict = model_to_dict(proposal,
+                                  exclude=["location", "fulltext", "search"])
+            pdict["location"] = {"lat": proposal.location.y,
+                                 "lng": proposal.location.x}
+            pdict["documents"] = [d.to_dict() for d in proposal.documents.all()]
+            images = proposal.images.order_by("-priority")[0:include_images]
+            pdict["images"] = [img.to_dict() for img in images]
+            pdict["attributes"] = [
+                a.to_dict() for a in proposal.attributes.filter(
+                    hidden=False, handle__in=views.default_attributes)]
+            pdict["events"] = [e.to_json_dict() for e in proposal.events.all()]
+            return pdict
+
+        first, second, third = Proposal.objects.order_by("pk")
+        # The proposals have different numbers of images:
+        for priority in (3, 1, 2):
+            first.images.create(url=f"http://localhost/first-{priority}.jpg",
+                                width=10, height=10, priority=priority)
+        third.images.create(url="http://localhost/third.jpg", width=10,
+                            height=10)
+        # ...and different visible attributes:
+        first.attributes.create(name="Legal Notice", handle="legal_notice",
+                                text_value="Notice", published=utc_now())
+        second.attributes.update(hidden=True)
+
+        proposals = [first, second, third]
+        batched = views.proposals_json(proposals, include_images=2,
+                                       include_events=True)
+        self.assertEqual(batched, [single_json(p, 2) for p in proposals])
+        self.assertEqual([len(p["images"]) for p in batched], [2, 0, 1])
+        self.assertEqual([len(p["attributes"]) for p in batched], [2, 0, 1])
+
+    def test_partial_text_search(self):
+        def search(text):
+            return Proposal.objects.filter(
+                **build_proposal_query_dict({"text": text})).count()
+
+        # Prefixes of words in the search vector:
+        self.assertEqual(search("Cherr Stre"), 3)
+        self.assertEqual(search("ZBA 2017"), 3)
+        # Part of the address:
+        self.assertEqual(search("1 Cher"), 3)
+        self.assertEqual(search("Elm"), 0)
+
+    def test_query_count(self):
+        proposals = list(Proposal.objects.all())
+        # One query each for documents, images, attributes, and events:
+        with self.assertNumQueries(4):
+            views.proposals_json(proposals, include_images=1,
+                                 include_events=True)
+
+    def test_cursor_pagination(self):
+        proposals = list(Proposal.objects.order_by("-updated", "-pk"))
+        first = views._cursor_context(Proposal.objects.all(), "", 2)
+        self.assertEqual([p["id"] for p in first["proposals"]],
+                         [p.pk for p in proposals[0:2]])
+        cursor = first["paginator"]["next_cursor"]
+        self.assertTrue(cursor)
+
+        second = views._cursor_context(Proposal.objects.all(), cursor, 2)
+        self.assertEqual([p["id"] for p in second["proposals"]],
+                         [p.pk for p in proposals[2:4]])
+        self.assertIsNone(second["paginator"]["next_cursor"])
+
+        with self.assertRaises(ErrorResponse):
+            views.cursor_query("not a cursor")
+        # Well-formed, but without a valid date:
+        bad_cursor = urlsafe_b64encode(b'["not a date", 1]').decode()
+        with self.assertRaises(ErrorResponse) as cm:
+            views.cursor_query(bad_cursor)
+        self.assertEqual(cm.exception.status, 400)
+
+        # Results ranked by a text query can't be paged with a cursor:
+        response = self.client.get(reverse("list-proposals"),
+                                   {"cursor": "", "text": "Cherry"})
+        self.assertEqual(response.status_code, 400)
+
     def tearDown(self):
         Proposal.objects.all().delete()
 
 
+@tag("proposal", "cache")
+class TestCaching(TestCase):
+    def test_cache_key(self):
+        q1 = build_proposal_query_dict({"region": "Somerville, MA",
+                                        "box": "42.37,-71.13,42.40,-71.06"})
+        q2 = build_proposal_query_dict({"box": "42.37,-71.13,42.40,-71.06",
+                                        "region": "Somerville, MA"})
+        key = caching.cache_key("test", [q1], page=1)
+        self.assertEqual(key, caching.cache_key("test", [q2], page=1))
+        self.assertNotEqual(key, caching.cache_key("test", [q1], page=2))
+
+        caching.bump_generation()
+        self.assertNotEqual(key, caching.cache_key("test", [q1], page=1))
+
+    def test_relative_time_cache_key(self):
+        # Relative time ranges are converted to the current time minus an
+        # offset, so times are rounded to make equivalent queries share a key:
+        when = datetime(2018, 6, 1, 12, 1)
+        self.assertEqual(caching.normalize_value(when),
+                         caching.normalize_value(when + timedelta(minutes=5)))
+        self.assertNotEqual(caching.normalize_value(when),
+                            caching.normalize_value(when + timedelta(hours=1)))
+
+
+@tag("proposal", "tiles")
+class TestTiles(TestCase):
+    def test_cluster_zoom(self):
+        response = self.client.get(reverse("list-clusters"),
+                                   {"box": "42.37,-71.13,42.40,-71.06",
+                                    "zoom": tiles.MAX_ZOOM + 1})
+        self.assertEqual(response.status_code, 400)
+
+    def test_tile_bounds(self):
+        e = tiles.MERCATOR_EXTENT
+        self.assertEqual(tiles.mercator_bounds(0, 0, 0), (-e, -e, e, e))
+        self.assertEqual(tiles.mercator_bounds(1, 1, 0), (0, 0, e, e))
+
+        swlat, swlng, nelat, nelng = map(float, tiles.tile_box(1, 1, 0).split(","))
+        self.assertAlmostEqual(swlat, 0)
+        self.assertAlmostEqual(swlng, 0)
+        self.assertAlmostEqual(nelat, 85.0511287798, places=6)
+        self.assertAlmostEqual(nelng, 180)
+
+        self.assertFalse(tiles.valid_tile(1, 2, 0))
+
+
+@tag("proposal", "documents")
+class TestDocumentText(TestCase):
+    def test_split_pages(self):
+        self.assertEqual(documents.split_pages("one\ftwo\n\f"),
+                         ["one", "two\n"])
+        self.assertEqual(documents.split_pages("one\x00\f\ftwo"),
+                         ["one", "", "two"])
+
+    def test_iter_pages(self):
+        (_, proposal) = Proposal.create_or_update_from_dict(
+            proposal_dict_with_location.copy())
+        doc = proposal.documents.all()[0]
+        documents.save_pages(doc, ["one\n", "two\nlines\n", "three"])
+
+        self.assertEqual(list(doc.iter_pages(2, 3)),
+                         [(2, "two\nlines\n"), (3, "three")])
+        self.assertEqual(list(doc.line_iterator),
+                         ["one\n", "two\n", "lines\n", "three"])
+
+    @override_settings(PDF_PAGES_PER_RANGE=2)
+    def test_extract_text(self):
+        (_, proposal) = Proposal.create_or_update_from_dict(
+            proposal_dict_with_location.copy())
+        doc = proposal.documents.all()[0]
+        texts = [f"Page {n}" for n in range(1, 6)]
+        doc.document.save("download.pdf", ContentFile(make_pdf(texts)))
+
+        # The five pages are extracted in three ranges:
+        pages = files.extract_pages(doc.local_path, pages_per_range=2)
+        self.assertEqual([page.strip() for page in pages], texts)
+
+        self.assertTrue(documents.extract_text(doc))
+        self.assertEqual([text.strip() for text in
+                          doc.pages.order_by("number")
+                          .values_list("text", flat=True)], texts)
+        doc.delete()
+
+    def test_reuse_processed(self):
+        (_, proposal) = Proposal.create_or_update_from_dict(
+            proposal_dict_with_location.copy())
+        source, doc = proposal.documents.all()[0:2]
+        source.sha256 = "a"*64
+        source.document = "doc/sha256/aa/%s/download.pdf" % source.sha256
+        with open(documents.derived_path(source, "text.txt"), "w") as out:
+            out.write("Page one\f")
+        source.fulltext = documents.derived_name(source, "text.txt")
+        source.encoding = "utf-8"
+        source.processing_state = "processed"
+        source.save()
+        source.pages.create(number=1, text="Page one")
+        source.images.create(proposal=proposal, image="image-000.jpg",
+                             width=10, height=10)
+
+        self.assertEqual(documents.find_duplicate(doc, source.sha256), source)
+        self.assertIsNone(documents.find_duplicate(source, source.sha256))
+
+        documents.reuse_processed(doc, source)
+        doc.refresh_from_db()
+        self.assertEqual(doc.document.name, source.document.name)
+        # Each document has its own copy of the text:
+        self.assertEqual(doc.fulltext.name,
+                         documents.derived_name(doc, "text.txt"))
+        self.assertEqual(doc.get_text(), "Page one\f")
+        self.assertIsNone(doc.thumbnail.name)
+        self.assertEqual(list(doc.pages.values_list("text", flat=True)),
+                         ["Page one"])
+        # The source image already belongs to the proposal:
+        self.assertEqual(proposal.images.count(), 1)
+
+        text_path = doc.fulltext.path
+        doc.delete()
+        self.assertFalse(os.path.exists(text_path))
+        self.assertTrue(os.path.exists(source.fulltext.path))
+        source.delete()
+
+
 @tag("tasks")
 class TestTasks(TestCase):
     @classmethod
@@ -162,6 +591,31 @@ class TestTasks(TestCase):
         self.assertFalse(os.path.exists(doc_path),
                          "Document file was not deleted")
 
+    def test_document_graph(self):
+        doc = self.proposal.documents.all()[0]
+        doc.document.save("download.pdf",
+                          ContentFile(make_pdf(["Page one", "Page two"])))
+
+        eager = celery_app.conf.task_always_eager
+        celery_app.conf.task_always_eager = True
+        try:
+            tasks.document_graph(doc, True).apply_async()
+        finally:
+            celery_app.conf.task_always_eager = eager
+
+        # finish_document_processing ran after the text, image and thumbnail
+        # branches had finished:
+        doc.refresh_from_db()
+        self.assertEqual(doc.processing_state, "processed")
+        self.assertEqual(doc.pages.count(), 2)
+        self.assertTrue(doc.thumbnail)
+        doc.delete()
+
+    def test_recheck_documents(self):
+        # None of the documents of incomplete proposals have been processed:
+        self.assertEqual(tasks.recheck_documents(), [])
+        self.assertEqual(tasks.recheck_documents([self.proposal.pk]), [])
+
     # def test_street_view(self):
     #     before_count = self.proposal.images.count()
     #     tasks.add_street_view(self.proposal.id)
@@ -0,0 +1,118 @@
+"""Helpers for rendering proposal markers as Mapbox Vector Tiles and for
+clustering markers at low zoom levels.
+"""
+from math import atan, degrees, pi, sinh
+
+from django.db import connection
+
+
+# Half the width of the Web Mercator projection, in meters:
+MERCATOR_EXTENT = 20037508.342789244
+MAX_ZOOM = 22
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+# Markers are clustered into cells of this size, in pixels, when the map is
+# drawn with 256 pixel tiles:
+CLUSTER_CELL_PIXELS = 64
+
+
+def valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2**z and 0 <= y < 2**z
+
+
+def tile_lat(y, z):
+    return degrees(atan(sinh(pi * (1 - 2 * y / 2**z))))
+
+
+def tile_lng(x, z):
+    return x / 2**z * 360 - 180
+
+
+def tile_box(z, x, y):
+    """Returns the bounds of the tile as a `box` string, suitable for passing to
+    `build_proposal_query_dict`.
+    """
+    return ",".join(map(str, [tile_lat(y+1, z), tile_lng(x, z),
+                              tile_lat(y, z), tile_lng(x+1, z)]))
+
+
+def mercator_bounds(z, x, y):
+    "Returns the bounds of the tile in Web Mercator (EPSG:3857) coordinates."
+    size = 2 * MERCATOR_EXTENT / 2**z
+    return (-MERCATOR_EXTENT + x * size,
+            MERCATOR_EXTENT - (y + 1) * size,
+            -MERCATOR_EXTENT + (x + 1) * size,
+            MERCATOR_EXTENT - y * size)
+
+
+def proposal_tile(proposals, z, x, y, layer_name="proposals"):
+    """Renders the locations of the given proposals that fall within a tile.
+
+    :param proposals: a Proposal queryset, which should already be filtered to
+    the bounds of the tile
+    :param z, x, y: tile coordinates
+
+    :returns: bytes containing the encoded tile. Each feature has `id` and
+    `status` properties.
+    """
+    inner_sql, inner_params = proposals.values("id", "status", "location")\
+                                       .query.sql_with_params()
+    sql = f"""
+    SELECT ST_AsMVT(tile, %s, {TILE_EXTENT}, 'geom') FROM (
+      SELECT p.id, p.status,
+             ST_AsMVTGeom(ST_Transform(p.location::geometry, 3857),
+                          ST_MakeEnvelope(%s, %s, %s, %s, 3857),
+                          {TILE_EXTENT}, {TILE_BUFFER}, true) AS geom
+      FROM ({inner_sql}) p
+    ) AS tile
+    WHERE geom IS NOT NULL
+    """
+    params = [layer_name, *mercator_bounds(z, x, y), *inner_params]
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        tile = cursor.fetchone()[0]
+
+    return bytes(tile) if tile else b""
+
+
+def cluster_cell_size(zoom):
+    "Returns the width of a cluster grid cell at the given zoom, in meters."
+    return 2 * MERCATOR_EXTENT / 2**zoom * CLUSTER_CELL_PIXELS / 256
+
+
+def proposal_clusters(proposals, zoom, max_ids=5):
+    """Groups the given proposals into clusters by snapping their locations to a
+    grid whose cell size depends on the zoom level. The work is done in a
+    single query, so the size of the response depends only on the area and
+    zoom of the map.
+
+    :param proposals: a Proposal queryset
+    :param zoom: the map zoom level
+    :param max_ids: include the ids of at most this many of the most recently
+    updated proposals in each cluster
+
+    :returns: a list of dicts with "count", "lat", "lng" (the centroid of the
+    clustered proposals), and "ids" keys
+    """
+    inner_sql, inner_params = proposals.values("id", "updated", "location")\
+                                       .query.sql_with_params()
+    sql = f"""
+    SELECT count(*),
+           ST_Y(ST_Transform(ST_Centroid(ST_Collect(geom)), 4326)),
+           ST_X(ST_Transform(ST_Centroid(ST_Collect(geom)), 4326)),
+           (array_agg(id ORDER BY updated DESC))[1:%s]
+    FROM (
+      SELECT p.id, p.updated,
+             ST_Transform(p.location::geometry, 3857) AS geom
+      FROM ({inner_sql}) p
+      WHERE p.location IS NOT NULL
+    ) q
+    GROUP BY ST_SnapToGrid(geom, %s)
+    """
+    params = [max_ids, *inner_params, cluster_cell_size(zoom)]
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [{"count": count, "lat": lat, "lng": lng, "ids": ids}
+                for count, lat, lng, ids in cursor.fetchall()]
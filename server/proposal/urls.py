@@ -9,6 +9,9 @@ doc_urlpatterns = [
 
 urlpatterns = [
     path("list", views.list_proposals, name="list-proposals"),
+    path("tiles/<int:z>/<int:x>/<int:y>.mvt", views.proposal_tile,
+         name="proposal-tile"),
+    path("clusters", views.list_clusters, name="list-clusters"),
     path("view", views.view_proposal),
     path("view/<int:pk>", views.view_proposal, name="view-proposal"),
     path("events", views.list_events, name="list-events"),
@@ -1,21 +1,29 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from celery import shared_task
+from collections import defaultdict
 from functools import reduce
+from itertools import islice
 import json
 from operator import or_
 from urllib import parse
 
 from django.conf import settings
 from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
-from django.db.models import Q
+from django.db.models import OuterRef, Q, Subquery
+from django.db.models.query import QuerySet
 from django.forms.models import model_to_dict
-from django.http import FileResponse
+from django.http import FileResponse, Http404, HttpResponse
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
+from django.utils import dateparse
 
+from project.models import Project
 from shared.request import make_response, ErrorResponse
 
 from .models import Proposal, Attribute, Document, Event, Image, Layer
-from .query import build_proposal_query, build_event_query
+from .query import (approximate_count, build_proposal_query_dict,
+                    build_event_query, rank_by_document_text, rank_by_text)
+from . import caching, tiles
 from utils import bounds_from_box, add_params
 
 default_attributes = [
@@ -23,46 +31,116 @@ default_attributes = [
 ]
 
 
-def proposal_json(proposal,
-                  include_images=True,
-                  include_attributes=default_attributes,
-                  include_events=False,
-                  include_documents=True,
-                  include_projects=True):
-    pdict = model_to_dict(proposal, exclude=["location", "fulltext"])
-    pdict["location"] = {
-        "lat": proposal.location.y,
-        "lng": proposal.location.x
-    }
+def group_by_proposal(items, key=lambda item: item.proposal_id):
+    grouped = defaultdict(list)
+    for item in items:
+        grouped[key(item)].append(item)
+    return grouped
+
+
+def top_images(ids, n):
+    """Returns a queryset of the `n` highest priority Images for each of the
+    Proposals with the given ids.
+    """
+    top = Image.objects.filter(proposal=OuterRef("proposal"))\
+                       .order_by("-priority")\
+                       .values("pk")[0:n]
+    return Image.objects.filter(proposal_id__in=ids, pk__in=Subquery(top))
+
+
+def proposals_json(proposals,
+                   include_images=True,
+                   include_attributes=default_attributes,
+                   include_events=False,
+                   include_documents=True,
+                   include_projects=True):
+    """Serializes a collection of Proposals, loading the related models for all
+    of them with a fixed number of queries. The output for each proposal is the
+    same as `proposal_json`.
+
+    :param proposals: an iterable of Proposals, such as a queryset or Page
+    :param include_images: True to include all images, or a number to include
+    only the n images with the highest priority
+
+    :returns: a list of dicts
+    """
+    proposals = list(proposals)
+    ids = [p.pk for p in proposals]
 
     if include_documents:
-        pdict["documents"] = [d.to_dict() for d in proposal.documents.all()]
+        documents = group_by_proposal(Document.objects.filter(proposal_id__in=ids))
 
     if include_images:
-        images = proposal.images.order_by("-priority")
         # Booleans are considered integers
         if isinstance(include_images, int) and include_images is not True:
-            images = images[0:include_images]
-
-        pdict["images"] = [img.to_dict() for img in images]
+            images = top_images(ids, include_images)
+        else:
+            images = Image.objects.filter(proposal_id__in=ids)
+        images = group_by_proposal(images.order_by("-priority"))
 
     if include_attributes:
-        attributes = proposal.attributes.filter(hidden=False)
+        attributes = Attribute.objects.filter(proposal_id__in=ids, hidden=False)
         if include_attributes is not True:
             attributes = attributes.filter(handle__in=include_attributes)
-        pdict["attributes"] = [a.to_dict() for a in attributes]
+        attributes = group_by_proposal(attributes)
 
     if include_events:
-        pdict["events"] = [e.to_json_dict() for e in proposal.events.all()]
+        links = Event.proposals.through.objects\
+                                       .filter(proposal_id__in=ids)\
+                                       .select_related("event")
+        events = group_by_proposal(links, lambda link: link.proposal_id)
+
+    if include_projects:
+        projects = Project.objects.prefetch_related("budgetitem_set")\
+                                  .in_bulk({p.project_id for p in proposals
+                                            if p.project_id})
+
+    pdicts = []
+    for proposal in proposals:
+        pdict = model_to_dict(proposal, exclude=["location", "fulltext", "search"])
+        pdict["location"] = {
+            "lat": proposal.location.y,
+            "lng": proposal.location.x
+        }
+
+        if include_documents:
+            pdict["documents"] = [d.to_dict() for d in documents[proposal.pk]]
+
+        if include_images:
+            pdict["images"] = [img.to_dict() for img in images[proposal.pk]]
+
+        if include_attributes:
+            pdict["attributes"] = [a.to_dict() for a in attributes[proposal.pk]]
+
+        if include_events:
+            pdict["events"] = [link.event.to_json_dict()
+                               for link in events[proposal.pk]]
+
+        if include_projects and proposal.project_id in projects:
+            pdict["project"] = projects[proposal.project_id].to_dict()
 
-    if include_projects and proposal.project:
-        pdict["project"] = proposal.project.to_dict()
+        # TODO: Filter on parcel attributes
 
-    # TODO: Filter on parcel attributes
+        pdicts.append(pdict)
 
-    # TODO: fulltext query
+    return pdicts
 
-    return pdict
+
+def iter_proposals_json(proposals, chunk_size=500, **kwargs):
+    """Like `proposals_json`, but serializes the proposals in chunks as the
+    result is consumed, so that the whole collection is never held in memory.
+    """
+    proposals = proposals.iterator(chunk_size=chunk_size) \
+        if isinstance(proposals, QuerySet) else iter(proposals)
+    while True:
+        chunk = list(islice(proposals, chunk_size))
+        if not chunk:
+            break
+        yield from proposals_json(chunk, **kwargs)
+
+
+def proposal_json(proposal, **kwargs):
+    return proposals_json([proposal], **kwargs)[0]
 
 
 def layer_json(layer):
@@ -73,16 +151,23 @@ def layer_json(layer):
             "region_name": layer.region_name}
 
 
-def _query(req):
+def _query_dicts(req):
     queries = req.GET.getlist("query")
     if queries:
-        query = reduce(or_, (build_proposal_query(json.loads(q))
-                             for q in queries), Q())
-    else:
-        query = build_proposal_query(req.GET)
+        return [build_proposal_query_dict(json.loads(q)) for q in queries]
+    return [build_proposal_query_dict(req.GET)]
+
+
+def _query(req, query_dicts=None):
+    query = reduce(or_, (Q(**d) for d in (query_dicts or _query_dicts(req))),
+                   Q())
     proposals = Proposal.objects.filter(query)
     if "include_projects" in req.GET:
         proposals = proposals.select_related("project")
+    if req.GET.get("q"):
+        proposals = rank_by_document_text(proposals, req.GET["q"])
+    elif req.GET.get("text"):
+        proposals = rank_by_text(proposals, req.GET["text"])
     return proposals
 
 
@@ -101,41 +186,211 @@ def paginator_context(page, page_url=lambda page: f"?page={page}"):
     }
 
 
+def set_page_urls(pcontext, page_url):
+    """Fills in the URLs of a (possibly cached) paginator context for the
+    current request.
+    """
+    next_page = pcontext["next_page"]
+    prev_page = pcontext["page"] > 1 and pcontext["page"] - 1
+    pcontext["next_url"] = next_page and page_url(next_page)
+    pcontext["prev_url"] = prev_page and page_url(prev_page)
+    return pcontext
+
+
+def _list_context(proposals, page, per_page):
+    paginator = Paginator(proposals, per_page=per_page)
+    try:
+        proposals = paginator.page(page)
+    except (PageNotAnInteger, EmptyPage) as err:
+        raise ErrorResponse("No such page", {"page": page}, err=err)
+
+    return {"paginator": paginator_context(proposals),
+            "proposals": proposals_json(proposals, include_images=1,
+                                        include_events=True)}
+
+
+def encode_cursor(proposal):
+    """Returns an opaque string marking the position of `proposal` in a list
+    ordered by (updated, id).
+    """
+    position = [proposal.updated.isoformat(), proposal.pk]
+    return urlsafe_b64encode(json.dumps(position).encode("utf-8")).decode()
+
+
+def cursor_query(cursor):
+    """Returns a Q object matching the proposals that come after the cursor in
+    a list ordered by (updated, id), descending.
+    """
+    try:
+        updated, pk = json.loads(urlsafe_b64decode(cursor.encode("utf-8")))
+        updated, pk = dateparse.parse_datetime(updated), int(pk)
+    except (TypeError, ValueError) as err:
+        raise ErrorResponse("Invalid cursor", {"cursor": cursor},
+                            status=400, err=err)
+
+    if not updated:
+        raise ErrorResponse("Invalid cursor", {"cursor": cursor}, status=400)
+
+    # The leading condition lets Postgres use it as a bound on a scan of the
+    # (updated, id) index; it cannot do so for the OR alone.
+    return Q(updated__lte=updated) & \
+        (Q(updated__lt=updated) | Q(updated=updated, pk__lt=pk))
+
+
+def _cursor_context(proposals, cursor, per_page, count=None):
+    """Returns a page of proposals using keyset pagination. Unlike page-number
+    pagination, the cost of retrieving a page does not grow with its depth.
+    Proposals are always ordered by (updated, id), so cursors cannot be used
+    with text queries, which order proposals by rank.
+
+    :param cursor: a cursor string as returned by `encode_cursor`, or an empty
+    string to start from the most recently updated proposal
+    :param count: "exact" to include a count of all matching proposals,
+    "approximate" to include the planner's estimate, or None
+    """
+    context = {}
+    pcontext = {"per_page": per_page}
+
+    if count == "exact":
+        pcontext["count"] = proposals.count()
+    elif count == "approximate":
+        pcontext["count"] = approximate_count(proposals)
+
+    if cursor:
+        proposals = proposals.filter(cursor_query(cursor))
+
+    # Fetch an extra row to determine if there is another page:
+    proposals = list(proposals.order_by("-updated", "-pk")[0:per_page+1])
+    if len(proposals) > per_page:
+        proposals = proposals[0:per_page]
+        pcontext["next_cursor"] = encode_cursor(proposals[-1])
+    else:
+        pcontext["next_cursor"] = None
+
+    context["paginator"] = pcontext
+    context["proposals"] = proposals_json(
+        proposals, include_images=1, include_events=True)
+
+    return context
+
+
+def page_url(req, **params):
+    query_params = req.GET.copy()
+    for k, v in params.items():
+        query_params[k] = str(v)
+    return req.path + "?" + query_params.urlencode()
+
+
 # Views:
-@make_response("list.djhtml")
+@make_response("list.djhtml", stream=True)
 def list_proposals(req):
-    proposals = _query(req)
-
+    """List the proposals matching the query. By default, results are paginated
+    by page number. Include a `cursor` parameter (empty for the first page) to
+    use cursor pagination instead, optionally with `count` set to "exact" or
+    "approximate". Cursor pagination cannot be combined with the `q` or `text`
+    parameters.
+    """
     try:
         page = int(req.GET["page"])
     except (ValueError, KeyError):
         page = 1
 
-    context = {}
+    try:
+        per_page = min(int(req.GET.get("per_page", 50)), 50)
+    except ValueError:
+        per_page = 50
+
+    cursor = req.GET.get("cursor")
+    count = req.GET.get("count")
+    if cursor is not None and (req.GET.get("q") or req.GET.get("text")):
+        raise ErrorResponse("Cursor pagination cannot be used with a text query",
+                            {"cursor": cursor}, status=400)
+
+    query_dicts = _query_dicts(req)
+    key = caching.cache_key("proposal_list", query_dicts,
+                            site=req.site_name, page=page, per_page=per_page,
+                            cursor=cursor, count=count,
+                            include_projects="include_projects" in req.GET)
+
+    if not page and cursor is None:
+        # Stream all matching proposals. Too large to cache.
+        return {"proposals": iter_proposals_json(_query(req, query_dicts),
+                                                 include_images=1,
+                                                 include_events=True)}
+    elif cursor is None:
+        context = caching.get_or_compute(
+            key,
+            lambda: _list_context(_query(req, query_dicts), page, per_page))
+    else:
+        context = caching.get_or_compute(
+            key,
+            lambda: _cursor_context(_query(req, query_dicts), cursor,
+                                    per_page, count))
+
+    pcontext = context.get("paginator")
+    if pcontext and "next_cursor" in pcontext:
+        next_cursor = pcontext["next_cursor"]
+        pcontext["next_url"] = \
+            next_cursor and page_url(req, cursor=next_cursor)
+    elif pcontext:
+        set_page_urls(pcontext, lambda page: page_url(req, page=page))
 
-    if page:
-        try:
-            per_page = int(req.GET.get("per_page", 50))
-        except ValueError:
-            per_page = 50
-        paginator = Paginator(proposals, per_page=min(per_page, 50))
-        proposals = paginator.page(page)
-        try:
-            query_params = req.GET.copy()
-            def make_url(page):
-                query_params["page"] = str(page)
-                return req.path + "?" + query_params.urlencode()
+    return context
 
-            context["paginator"] = paginator_context(proposals, make_url)
-        except (PageNotAnInteger, EmptyPage) as err:
-            raise ErrorResponse("No such page", {"page": page}, err=err)
 
-    context["proposals"] = [
-        proposal_json(
-            proposal, include_images=1, include_events=True) for proposal in proposals
-    ]
+def proposal_tile(req, z, x, y):
+    """Renders the locations of proposals matching the query as a Mapbox Vector
+    Tile. Accepts the same filter parameters as `list_proposals`, except for
+    `box`, which is determined by the tile coordinates.
+    """
+    if not tiles.valid_tile(z, x, y):
+        raise Http404("No such tile")
 
-    return context
+    params = req.GET.dict()
+    params["box"] = tiles.tile_box(z, x, y)
+    query_dict = build_proposal_query_dict(params)
+
+    key = caching.cache_key("proposal_tile", [query_dict],
+                            site=req.site_name, tile=f"{z}/{x}/{y}")
+    tile = caching.get_or_compute(
+        key,
+        lambda: tiles.proposal_tile(Proposal.objects.filter(**query_dict),
+                                    z, x, y))
+
+    response = HttpResponse(tile,
+                            content_type="application/vnd.mapbox-vector-tile")
+    response["Access-Control-Allow-Origin"] = "*"
+    response["Cache-Control"] = f"public, max-age={settings.TILE_MAX_AGE}"
+    return response
+
+
+@make_response()
+def list_clusters(req):
+    """Groups the proposals matching the query into clusters. Requires `box` and
+    `zoom` parameters in addition to the usual filters.
+    """
+    if "box" not in req.GET:
+        raise ErrorResponse("Missing required parameter", {"param": "box"},
+                            status=400)
+    try:
+        zoom = int(req.GET["zoom"])
+    except (KeyError, ValueError) as err:
+        raise ErrorResponse("Missing or invalid zoom", {"param": "zoom"},
+                            status=400, err=err)
+
+    if not 0 <= zoom <= tiles.MAX_ZOOM:
+        raise ErrorResponse("Missing or invalid zoom", {"param": "zoom"},
+                            status=400)
+
+    query_dict = build_proposal_query_dict(req.GET)
+    key = caching.cache_key("proposal_clusters", [query_dict],
+                            site=req.site_name, zoom=zoom)
+    clusters = caching.get_or_compute(
+        key,
+        lambda: tiles.proposal_clusters(Proposal.objects.filter(**query_dict),
+                                        zoom))
+
+    return {"clusters": clusters}
 
 
 @make_response("view.djhtml")
@@ -208,14 +463,11 @@ def view_event(req, pk=None):
 
     event = get_object_or_404(Event, pk=pk)
     d = event.to_json_dict()
-    d["proposals"] = [
-        proposal_json(
-            p,
-            include_images=False,
-            include_attributes=["applicant_name", "legal_notice"],
-            include_documents=False)
-        for p in event.proposals.all().select_related("project")
-    ]
+    d["proposals"] = proposals_json(
+        event.proposals.all(),
+        include_images=False,
+        include_attributes=["applicant_name", "legal_notice"],
+        include_documents=False)
     return {"event": d}
 
 
@@ -5,9 +5,19 @@ from urllib.request import urlopen
 
 import requests
 
+from .batching import RequestFailed, RetryableError, run_batched
+
 
 ADDRESS_URL = "http://geocode.arcgis.com/arcgis/rest/services/World/GeocodeServer/geocodeAddresses"
 REVERSE_URL = "http://geocode.arcgis.com/arcgis/rest/services/World/GeocodeServer/reverseGeocode"
+TOKEN_URL = "https://www.arcgis.com/sharing/oauth2/token"
+
+# The World Geocoding Service's suggested maximum number of addresses per
+# geocodeAddresses request:
+BATCH_SIZE = 150
+
+# Error codes returned when the token is invalid, has expired, or is missing:
+TOKEN_ERROR_CODES = {498, 499}
 
 
 def camel_to_under(s):
@@ -21,6 +31,9 @@ def camel_to_under(s):
 def simplify(result):
     loc = result["location"]
     attrs = result["attributes"]
+    # Unmatched addresses have status "U":
+    if attrs.get("Status") == "U" or not loc:
+        return None
     return {
         "location": {
             "lng": loc["x"],
@@ -40,13 +53,30 @@ def reverse_geocode(token, lat, lng):
 
 
 class ArcGISCoder(object):
-    def __init__(self, client_id, client_secret, url=ADDRESS_URL):
+    def __init__(self, client_id, client_secret, url=ADDRESS_URL,
+                 token_url=TOKEN_URL, batch_size=BATCH_SIZE, concurrency=2,
+                 rate=None, retries=3, backoff=1.0):
+        """
+        :param batch_size: maximum number of addresses to send per request
+        :param concurrency: number of requests to send at a time
+        :param rate: maximum number of requests per second, or None
+        :param retries: number of times to retry a request that failed because
+        of a server error
+        :param backoff: seconds to wait before retrying a failed request
+        """
         assert client_id and client_secret, \
             "You must supply a client id and secret to ArcGISCoder"
 
         self.client_id = client_id
         self.client_secret = client_secret
         self.url = url
+        self.token_url = token_url
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.rate = rate
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
         self.access_token = None
 
     def get_access_token(self):
@@ -57,17 +87,13 @@ class ArcGISCoder(object):
                           ("client_id", self.client_id),
                           ("client_secret", self.client_secret)]).\
                           encode("ISO-8859-1")
-        f = urlopen("https://www.arcgis.com/sharing/oauth2/token",
-                    data)
+        f = urlopen(self.token_url, data)
         json_response = json.loads(f.read().decode("utf-8"))
 
         self.access_token = json_response["access_token"]
         return self.access_token
 
-    def geocode(self, addrs, **kwargs):
-        if isinstance(addrs, str):
-            addrs = [addrs]
-
+    def geocode_chunk(self, addrs):
         addresses = json.dumps(
             {"records":
              [{"attributes":
@@ -83,10 +109,49 @@ class ArcGISCoder(object):
             "f": "json"
         }
 
-        f = urlopen(self.url, urlencode(data).encode("ISO-8859-1"))
-        result = json.loads(f.read().decode("utf-8"))
+        try:
+            response = self.session.post(self.url, data=data)
+        except (requests.ConnectionError, requests.Timeout) as err:
+            raise RetryableError(err)
+        if response.status_code == 429 or response.status_code >= 500:
+            raise RetryableError(f"HTTP {response.status_code}")
+        if response.status_code >= 400:
+            raise RequestFailed(f"HTTP {response.status_code}")
+
+        result = response.json()
+        if "error" in result:
+            error = result["error"]
+            code = error.get("code")
+            if code in TOKEN_ERROR_CODES:
+                # Fetch a new token on the next attempt:
+                self.access_token = None
+                raise RetryableError(error.get("message"))
+            if code == 429 or (code or 0) >= 500:
+                raise RetryableError(error.get("message"))
+            raise RequestFailed(error.get("message"))
+
+        # The locations are not necessarily returned in the order of the
+        # records. ResultID is the OBJECTID of the matching record.
+        by_id = {l["attributes"]["ResultID"]: l for l in result["locations"]}
+        return [simplify(by_id[i+1]) if i+1 in by_id else None
+                for i in range(len(addrs))]
+
+    def geocode(self, addrs, **kwargs):
+        """Geocodes addresses in batches of at most `batch_size`.
+
+        :returns: a list of results, in the same order as `addrs`. Results
+        are None for addresses that could not be geocoded, and
+        batching.FAILED for addresses whose request failed.
+        """
+        if isinstance(addrs, str):
+            addrs = [addrs]
 
-        return [simplify(l) for l in result["locations"]]
+        return run_batched(self.geocode_chunk, addrs,
+                           chunk_size=self.batch_size,
+                           concurrency=self.concurrency,
+                           rate=self.rate,
+                           retries=self.retries,
+                           backoff=self.backoff)
 
     def reverse_geocode(self, lat, lng):
         result = reverse_geocode(self.get_access_token(), lat, lng)
@@ -0,0 +1,133 @@
+"""Helpers for sending many requests to a rate-limited web service.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class RetryableError(Exception):
+    """Raised by request functions when a request failed but may succeed if it
+    is retried, e.g., because the service is temporarily overloaded.
+    """
+    pass
+
+
+class RequestFailed(Exception):
+    """Raised by request functions when a request failed and retrying it will
+    not help, e.g., because it was rejected by the service.
+    """
+    pass
+
+
+class FailedResult(object):
+    """The type of `FAILED`, which `run_batched` returns in place of the
+    results for items whose request failed. It is falsy, like the None returned
+    for items that have no result, but can be told apart from it.
+    """
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return "FAILED"
+
+
+FAILED = FailedResult()
+
+
+class TokenBucket(object):
+    """Limits the rate of requests across threads. Up to `capacity` requests
+    can be made at once, after which requests are limited to `rate` per
+    second.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+
+def call_with_retries(fn, args, bucket=None, retries=3, backoff=1.0):
+    """Calls `fn(*args)`, retrying with exponential backoff if it raises a
+    RetryableError.
+    """
+    for attempt in range(retries + 1):
+        if bucket:
+            bucket.acquire()
+        try:
+            return fn(*args)
+        except RetryableError as err:
+            if attempt == retries:
+                raise
+            delay = backoff * 2**attempt
+            logger.warning("Request failed (%s); retrying in %.1fs", err, delay)
+            time.sleep(delay)
+
+
+def call_chunk(fn, batch, bucket=None, retries=3, backoff=1.0):
+    """Calls `fn` on a chunk of items with retries. If the call fails, logs the
+    error and returns FAILED for each item, so that one failed request does
+    not prevent the other chunks from being processed.
+    """
+    try:
+        return call_with_retries(fn, (batch,), bucket, retries, backoff)
+    except Exception as err:
+        logger.error("Request for %i item(s) failed: %s", len(batch), err)
+        return [FAILED] * len(batch)
+
+
+def run_batched(fn, items, chunk_size=1, concurrency=5, rate=None,
+                retries=3, backoff=1.0):
+    """Calls `fn` on chunks of `items` concurrently, limiting the rate of calls
+    and retrying failed calls.
+
+    :param fn: a function that takes a list of at most `chunk_size` items and
+    returns a list of the same length
+    :param items: a sequence
+    :param chunk_size: the largest number of items to pass to `fn` at once,
+    e.g., the maximum batch size of a web service
+    :param concurrency: the number of chunks to process at a time
+    :param rate: the maximum number of calls to `fn` per second, or None for
+    no limit
+    :param retries: the number of times to retry a call that raises a
+    RetryableError
+    :param backoff: seconds to wait before the first retry. The delay doubles
+    with each retry.
+
+    :returns: a list with the results for each item, in the same order as
+    `items`. The results for items in a chunk whose call failed, even after
+    retrying, are FAILED.
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    bucket = rate and TokenBucket(rate)
+    batches = list(chunks(items, chunk_size))
+    with ThreadPoolExecutor(min(concurrency, len(batches))) as executor:
+        futures = [executor.submit(call_chunk, fn, batch, bucket, retries,
+                                   backoff)
+                   for batch in batches]
+        return [result for future in futures for result in future.result()]
@@ -0,0 +1,211 @@
+"""An HTTP client for downloading large files from slow servers.
+
+Connections are pooled and reused, and the number of requests sent to each
+host at the same time is limited (within a process). Downloads are
+conditional, are streamed to disk with a size limit, and can be resumed with a
+range request if an earlier attempt was interrupted.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+import hashlib
+import json
+import os
+import threading
+from urllib import parse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class DownloadTooLarge(Exception):
+    pass
+
+
+class Download(object):
+    """The result of `DownloadClient.fetch`."""
+    def __init__(self, response, path=None, size=0, digest=None):
+        self.status = response.status_code
+        self.reason = response.reason
+        self.headers = response.headers
+        self.ok = response.ok
+        self.path = path
+        self.size = size
+        self.digest = digest
+
+    @property
+    def not_modified(self):
+        return self.status == 304
+
+    @property
+    def etag(self):
+        return self.headers.get("ETag", "")
+
+    @property
+    def last_modified(self):
+        return self.headers.get("Last-Modified", "")
+
+
+def conditional_headers(etag="", last_modified=""):
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return headers
+
+
+def remove(*paths):
+    for p in paths:
+        try:
+            os.remove(p)
+        except FileNotFoundError:
+            pass
+
+
+class DownloadClient(object):
+    def __init__(self, max_per_host=2, pool_size=10, timeout=60,
+                 max_size=None, chunk_size=65536, user_agent=None):
+        """
+        :param max_per_host: the maximum number of concurrent requests to a
+        single host
+        :param pool_size: the number of connections to keep open to each host
+        :param timeout: seconds to wait for the server to respond or send data
+        :param max_size: the size, in bytes, of the largest file that will be
+        downloaded, or None for no limit
+        """
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if user_agent:
+            self.session.headers["User-Agent"] = user_agent
+        # Byte ranges refer to the encoded body, so don't request compression:
+        self.session.headers["Accept-Encoding"] = "identity"
+
+        self.timeout = timeout
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        self.host_slots = defaultdict(
+            lambda: threading.BoundedSemaphore(max_per_host))
+
+    @contextmanager
+    def host_slot(self, url):
+        with self.lock:
+            slot = self.host_slots[parse.urlsplit(url).netloc]
+        with slot:
+            yield
+
+    def head(self, url, etag="", last_modified=""):
+        """Checks whether the resource at `url` has changed without
+        downloading it.
+
+        :param etag: the ETag of the saved copy, if known
+        :param last_modified: the Last-Modified header sent with the saved
+        copy, if known
+
+        :returns: False if the server reports that the resource is unchanged,
+        True if it has changed, or None if it can't be determined
+        """
+        with self.host_slot(url):
+            response = self.session.head(
+                url, headers=conditional_headers(etag, last_modified),
+                timeout=self.timeout, allow_redirects=True)
+
+        if response.status_code == 304:
+            return False
+        if not response.ok:
+            # Some servers don't support HEAD requests.
+            return None
+
+        new_etag = response.headers.get("ETag")
+        if etag and new_etag:
+            return new_etag != etag
+        new_modified = response.headers.get("Last-Modified")
+        if last_modified and new_modified:
+            return new_modified != last_modified
+
+        return None
+
+    def partial_validator(self, dest, url):
+        """Returns the validator (ETag or Last-Modified) sent with an
+        interrupted download of `url` to `dest`, or None if there is no
+        download to resume.
+        """
+        try:
+            with open(dest + ".meta") as meta_file:
+                meta = json.load(meta_file)
+            if meta["url"] == url and os.path.getsize(dest):
+                return meta["validator"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def fetch(self, url, dest, etag="", last_modified="", resume=True):
+        """Downloads the resource at `url` to the file `dest`, unless it has
+        not been modified. If an earlier download to `dest` was interrupted and
+        the resource has not changed, only the remaining bytes are requested.
+
+        :param url: URL string
+        :param dest: path of the file to write
+        :param etag: the ETag of the saved copy, if any
+        :param last_modified: the Last-Modified header of the saved copy, if
+        any
+        :param resume: if False, always download the entire file
+
+        :returns: a Download. Its digest is the hex SHA-256 digest of the
+        downloaded file.
+        """
+        headers = conditional_headers(etag, last_modified)
+        validator = resume and self.partial_validator(dest, url)
+        offset = 0
+        if validator:
+            offset = os.path.getsize(dest)
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = validator
+
+        with self.host_slot(url), \
+             self.session.get(url, headers=headers, stream=True,
+                              timeout=self.timeout) as response:
+            if response.status_code == 304 or not response.ok:
+                if response.status_code == 304:
+                    remove(dest, dest + ".meta")
+                return Download(response)
+
+            if response.status_code != 206:
+                offset = 0
+
+            length = response.headers.get("Content-Length")
+            if self.max_size and length and \
+               offset + int(length) > self.max_size:
+                remove(dest, dest + ".meta")
+                raise DownloadTooLarge(url)
+
+            validator = response.headers.get("ETag") or \
+                response.headers.get("Last-Modified")
+            if validator:
+                with open(dest + ".meta", "w") as meta_file:
+                    json.dump({"url": url, "validator": validator}, meta_file)
+            else:
+                remove(dest + ".meta")
+
+            digest = hashlib.sha256()
+            size = offset
+            with open(dest, "r+b" if offset else "wb") as out:
+                if offset:
+                    for chunk in iter(lambda: out.read(self.chunk_size), b""):
+                        digest.update(chunk)
+
+                for chunk in response.iter_content(self.chunk_size):
+                    size += len(chunk)
+                    if self.max_size and size > self.max_size:
+                        break
+                    digest.update(chunk)
+                    out.write(chunk)
+
+        if self.max_size and size > self.max_size:
+            remove(dest, dest + ".meta")
+            raise DownloadTooLarge(url)
+
+        remove(dest + ".meta")
+        return Download(response, dest, size, digest.hexdigest())
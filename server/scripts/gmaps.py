@@ -1,6 +1,4 @@
 import json
-import threading
-from queue import Queue
 
 import logging
 
@@ -9,24 +7,41 @@ from urllib.request import urlopen
 
 import requests
 
+from .batching import RequestFailed, RetryableError, run_batched
+
 logger = logging.getLogger(__name__)
 
 URL = "https://maps.googleapis.com/maps/api/geocode/json"
 
-def geocode(api_key, address, bounds=None):
-    json_response = requests.get(
-        URL,
-        {"key": api_key,
-         "address": address,
-         "bounds": bounds or ""}
-    ).json()
-
-    if json_response["status"] == "OK":
+# Response statuses that indicate that a request may succeed if retried:
+RETRY_STATUSES = {"OVER_QUERY_LIMIT", "UNKNOWN_ERROR"}
+
+
+def geocode(api_key, address, bounds=None, url=URL, session=requests):
+    try:
+        response = session.get(
+            url,
+            params={"key": api_key,
+                    "address": address,
+                    "bounds": bounds or ""})
+    except (requests.ConnectionError, requests.Timeout) as err:
+        raise RetryableError(err)
+    if response.status_code == 429 or response.status_code >= 500:
+        raise RetryableError(f"HTTP {response.status_code}")
+    json_response = response.json()
+
+    status = json_response["status"]
+    if status == "OK":
         return json_response["results"][0]
+    elif status == "ZERO_RESULTS":
+        return None
+    elif status in RETRY_STATUSES:
+        raise RetryableError(status)
     else:
-        logger.error("Error encountered while geocoding address: " +
-                     "{address}\n{error}"
-                     .format(address=address, error=json_response))
+        # The request was denied or invalid, or the quota is used up.
+        raise RequestFailed("{status} while geocoding {address}: {error}"
+                            .format(status=status, address=address,
+                                    error=json_response.get("error_message")))
 
 
 def simplify(result):
@@ -59,34 +74,25 @@ def reverse_geocode(api_key, lat, lng):
         return data[0]["address_components"]
 
 
-class GeocoderThread(threading.Thread):
-    def __init__(self, addr_q, out, geocoder):
-        self.addr_q = addr_q
-        self.out = out
-        self.geocoder = geocoder
-        super().__init__()
-
-    def start(self):
-        while True:
-            address = self.addr_q.get_nowait()
-
-            if not address:
-                break
-
-            try:
-                print("Geocoding address:", address)
-                result = geocode(self.geocoder.api_key, address)
-                # Could return None
-                self.out.append((address, result and simplify(result)))
-            except Exception as err:
-                print("Error in thread", self, err)
-            finally:
-                self.addr_q.task_done()
-
-
 class GoogleGeocoder(object):
-    def __init__(self, api_key):
+    def __init__(self, api_key, url=URL, concurrency=5, rate=None, retries=3,
+                 backoff=1.0):
+        """
+        :param api_key: Google Maps API key
+        :param url: URL of the geocoding endpoint
+        :param concurrency: number of requests to send at a time
+        :param rate: maximum number of requests per second, or None
+        :param retries: number of times to retry a request that failed because
+        of rate limiting or a server error
+        :param backoff: seconds to wait before retrying a failed request
+        """
         self.api_key = api_key
+        self.url = url
+        self.concurrency = concurrency
+        self.rate = rate
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
         self._bounds = None
 
     @property
@@ -99,35 +105,28 @@ class GoogleGeocoder(object):
         self._bounds = "{bounds[0]},{bounds[3]}|{bounds[2]},{bounds[1]}"\
             .format(bounds=bounds)
 
-    def geocode_threaded(self, addrs, parallelism=5):
-        address_q = Queue(len(addrs))
-        for addr in addrs:
-            address_q.put_nowait(addr)
-
-        # Use a list to collect results, because .append() is
-        # thread-safe
-        out = []
-
-        for i in range(parallelism):
-            gt = GeocoderThread(address_q, out, self)
-            gt.start()
+    def geocode_chunk(self, addrs):
+        return [simplify(geocode(self.api_key, addr, self.bounds, self.url,
+                                 self.session))
+                for addr in addrs]
 
-        address_q.join()
-
-        # Out is a list of pairs of (addr, result)
-        results = dict(out)
-
-        # Pluck out the results in the same order as the input
-        # addresses:
-        return [results[a] for a in addrs]
+    def geocode_threaded(self, addrs, parallelism=5):
+        return run_batched(self.geocode_chunk, addrs, concurrency=parallelism,
+                           rate=self.rate, retries=self.retries,
+                           backoff=self.backoff)
 
     def geocode(self, addrs, bounds=None, region=None):
-        results = []
-        for addr in addrs:
-            if region:
-                addr += " " + region
-            results.append(simplify(geocode(self.api_key, addr, self.bounds)))
-        return results
+        """Geocodes addresses concurrently.
+
+        :returns: a list of results, in the same order as `addrs`. Results
+        are None for addresses that could not be geocoded, and
+        batching.FAILED for addresses whose request failed.
+        """
+        if isinstance(addrs, str):
+            addrs = [addrs]
+        if region:
+            addrs = [addr + " " + region for addr in addrs]
+        return self.geocode_threaded(addrs, self.concurrency)
 
     def reverse_geocode(self, lat, lng):
         results = _reverse_geocode(self.api_key, lat, lng)
@@ -81,6 +81,7 @@ class ProposalAdmin(admin.ModelAdmin):
             old_attrs = {at.handle: at for at in Attribute.objects.filter(pk__in=pks)}
 
         super().save_related(request, form, formsets, change)
+        form.instance.update_search_vector()
         if not change:
             return
 
@@ -1,4 +1,6 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import logging
 import os
 import re
 import subprocess
@@ -7,6 +9,9 @@ import utils
 from dateutil.parser import parse as date_parse
 
 
+logger = logging.getLogger(__name__)
+
+
 class multimethod(object):
     class DispatchValueError(ValueError):
         pass
@@ -32,13 +37,13 @@ class multimethod(object):
             self.default_fn = fn
         return adder
 
-    def __call__(self, *args):
+    def __call__(self, *args, **kwargs):
         val = self.dispatch_fn(*args)
 
         if val in self.table:
-            return self.table[val](*args)
+            return self.table[val](*args, **kwargs)
         elif self.default_fn:
-            return self.default_fn(*args)
+            return self.default_fn(*args, **kwargs)
         else:
             raise multimethod.DispatchValueError(
                 "Unknown dispatch value:", val)
@@ -56,6 +61,8 @@ encoding.default(lambda _: "utf-8")
 
 extract_text = multimethod(extension)
 
+extract_pages = multimethod(extension)
+
 extract_images = multimethod(extension)
 
 # PDF
@@ -89,3 +96,74 @@ def extract_text(path, output_path):
     status = subprocess.call(["pdftotext", "-enc", encoding(path), path,
                               output_path])
     return not status
+
+
+def page_count(path):
+    proc = subprocess.run(["pdfinfo", path], stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE)
+    m = re.search(r"^Pages:\s+(\d+)", proc.stdout.decode("UTF-8", "replace"),
+                  re.M)
+    return m and int(m.group(1))
+
+
+def page_ranges(count, size):
+    """Splits pages 1 through `count` into ranges of at most `size` pages.
+
+    :returns: a list of (first, last) tuples
+    """
+    return [(first, min(first + size - 1, count))
+            for first in range(1, count + 1, size)]
+
+
+def extract_page_range(path, first, last, timeout=None):
+    """Extracts the text of pages `first` through `last` of a PDF.
+
+    :returns: a list with the text of each page in the range
+    """
+    out = subprocess.run(
+        ["pdftotext", "-enc", encoding(path), "-f", str(first), "-l",
+         str(last), path, "-"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout,
+        check=True).stdout
+    # pdftotext ends each page with a form feed. Replace undecodable bytes,
+    # rather than losing the text of the whole document:
+    pages = out.decode(encoding(path), "replace").replace("\x00", "")\
+               .split("\f")
+    count = last - first + 1
+    return (pages + [""] * count)[0:count]
+
+
+@extract_pages.add("pdf")
+def extract_pages(path, pages_per_range=20, workers=4, timeout=120):
+    """Extracts the text of a PDF page by page. Large documents are split into
+    ranges of pages, which are extracted in parallel by separate pdftotext
+    processes.
+
+    :param pages_per_range: the number of pages to extract with each process
+    :param workers: the number of processes to run at once
+    :param timeout: seconds to wait for a range of pages to be extracted. The
+    pages of a range that times out or fails are left empty.
+
+    :returns: a list with the text of each page, or None if no text could be
+    extracted
+    """
+    count = page_count(path)
+    if not count:
+        return None
+
+    def extract_range(page_range):
+        try:
+            return extract_page_range(path, *page_range, timeout=timeout)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as err:
+            logger.warning("Failed to extract pages %i-%i of %s: %s",
+                           page_range[0], page_range[1], path, err)
+
+    ranges = page_ranges(count, pages_per_range)
+    with ThreadPoolExecutor(min(workers, len(ranges))) as executor:
+        results = list(executor.map(extract_range, ranges))
+
+    if not any(results):
+        return None
+
+    return [text for (first, last), pages in zip(ranges, results)
+            for text in (pages or [""] * (last - first + 1))]
@@ -1,19 +1,139 @@
+from datetime import timedelta
+
 from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
 
 from django.contrib.gis.geos import Point
 
-from scripts import gmaps, arcgis
+from parcel.geocoder import ParcelGeocoder
+from scripts import arcgis, batching, gmaps
+from .address import normalize_street
+from .models import GeocodeCacheEntry
+
+
+def normalize_query(address):
+    """Normalizes an address for use as a geocode cache key, so that trivial
+    differences in case, punctuation, and street suffixes don't cause misses.
+    """
+    return normalize_street(address.replace(",", " "))[0:256]
+
+
+class CachingGeocoder(object):
+    """Wraps a geocoder, storing its responses in the database. Addresses that
+    have been geocoded recently, including those that could not be geocoded,
+    are not sent to the wrapped geocoder.
+    """
+    def __init__(self, geocoder, provider):
+        self.geocoder = geocoder
+        self.provider = provider
+
+    def __getattr__(self, name):
+        if name == "geocoder":
+            raise AttributeError(name)
+        return getattr(self.geocoder, name)
+
+    def __setattr__(self, name, value):
+        if name == "bounds":
+            self.geocoder.bounds = value
+        else:
+            super().__setattr__(name, value)
+
+    def cached(self, keys, region):
+        now = timezone.now()
+        fresh = (
+            Q(location__isnull=False,
+              created__gte=now - timedelta(seconds=settings.GEOCODE_CACHE_TTL)) |
+            Q(location__isnull=True,
+              created__gte=now - timedelta(seconds=settings.GEOCODE_NEGATIVE_TTL)))
+        return {entry.address: entry for entry in
+                GeocodeCacheEntry.objects.filter(fresh, address__in=keys,
+                                                 region=region)}
+
+    def store(self, results, region):
+        """
+        :param results: a dict mapping normalized addresses to geocoder
+        results or None
+        """
+        entries = []
+        for key, result in results.items():
+            entry = GeocodeCacheEntry(address=key, region=region,
+                                      provider=self.provider)
+            if result:
+                entry.location = as_point(result)
+                entry.formatted_name = result["formatted_name"][0:256]
+                entry.properties = result.get("properties", {})
+                entry.score = entry.properties.get("score")
+            entries.append(entry)
+
+        try:
+            with transaction.atomic():
+                GeocodeCacheEntry.objects.filter(address__in=list(results),
+                                                 region=region).delete()
+                GeocodeCacheEntry.objects.bulk_create(entries)
+        except IntegrityError:
+            # Another worker cached the same address at the same time.
+            pass
+
+    def geocode(self, addrs, **kwargs):
+        if isinstance(addrs, str):
+            addrs = [addrs]
+        else:
+            addrs = list(addrs)
+        region = kwargs.get("region") or ""
+
+        keys = [normalize_query(addr) for addr in addrs]
+        found = self.cached(keys, region)
+        misses = {}
+        for addr, key in zip(addrs, keys):
+            if key not in found:
+                misses.setdefault(key, addr)
+
+        if misses:
+            results = self.geocoder.geocode(list(misses.values()), **kwargs)
+            new_results = dict(zip(misses, results))
+            # Only cache addresses that were geocoded or had no results, not
+            # those whose request failed:
+            self.store({key: result for key, result in new_results.items()
+                        if result is not batching.FAILED}, region)
+        else:
+            new_results = {}
+
+        return [new_results[key] if key in new_results else
+                entry_result(found[key])
+                for key in keys]
+
+
+def entry_result(entry):
+    """Converts a GeocodeCacheEntry to the form returned by the geocoders."""
+    if entry.location:
+        return {"location": {"lat": entry.location.y,
+                             "lng": entry.location.x},
+                "formatted_name": entry.formatted_name,
+                "properties": entry.properties}
 
 
 if settings.GEOCODER == "google":
-    Geocoder = gmaps.GoogleGeocoder(settings.GOOGLE_API_KEY)
+    Geocoder = CachingGeocoder(
+        gmaps.GoogleGeocoder(settings.GOOGLE_API_KEY,
+                             concurrency=settings.GEOCODER_CONCURRENCY,
+                             rate=settings.GEOCODER_RATE),
+        "google")
     Geocoder.bounds = settings.GEO_BOUNDS
 elif settings.GEOCODER == "arcgis":
-    Geocoder = arcgis.ArcGISCoder(settings.ARCGIS_CLIENT_ID,
-                                  settings.ARCGIS_CLIENT_SECRET)
+    Geocoder = CachingGeocoder(
+        arcgis.ArcGISCoder(settings.ARCGIS_CLIENT_ID,
+                           settings.ARCGIS_CLIENT_SECRET,
+                           concurrency=settings.GEOCODER_CONCURRENCY,
+                           rate=settings.GEOCODER_RATE),
+        "arcgis")
 else:
     Geocoder = None
 
+if settings.GEOCODE_FROM_PARCELS:
+    Geocoder = ParcelGeocoder(Geocoder)
+
 
 def as_point(geo_response):
     return Point(x=geo_response["location"]["lng"],
@@ -25,3 +145,16 @@ def geocode_tuples(addrs, **kwargs):
     return [(addr, as_point(gr), gr["formatted_name"]) if gr else addr
             for addr, gr in
             zip(addrs, Geocoder.geocode(addrs, **kwargs))]
+
+
+def reverse_geocode_address(point):
+    """
+    :param point: a Point
+
+    :returns: the street address at the point, or None if the point could not
+    be reverse geocoded
+    """
+    try:
+        return Geocoder.reverse_geocode(point.y, point.x).split(",")[0]
+    except Exception:
+        return None
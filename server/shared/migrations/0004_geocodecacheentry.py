@@ -0,0 +1,32 @@
+import django.contrib.gis.db.models.fields
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shared', '0003_staffnotification_points'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeocodeCacheEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('address', models.CharField(max_length=256)),
+                ('region', models.CharField(blank=True, default='', max_length=64)),
+                ('location', django.contrib.gis.db.models.fields.PointField(null=True, srid=4326)),
+                ('formatted_name', models.CharField(blank=True, default='', max_length=256)),
+                ('score', models.FloatField(null=True)),
+                ('properties', django.contrib.postgres.fields.jsonb.JSONField(default=dict)),
+                ('provider', models.CharField(max_length=20)),
+                ('created', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='geocodecacheentry',
+            unique_together={('address', 'region')},
+        ),
+    ]
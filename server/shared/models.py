@@ -1,4 +1,6 @@
 from django.contrib.gis.db import models
+from django.contrib.postgres.fields import JSONField
+from django.utils import timezone
 
 from django.contrib.auth import get_user_model
 
@@ -28,3 +30,24 @@ class StaffNotification(models.Model):
 
     def __str__(self):
         return f"{self.sender}: {self.title}"
+
+
+class GeocodeCacheEntry(models.Model):
+    """A cached geocoder response. Entries with no location record that the
+    address could not be geocoded.
+    """
+    # Normalized address, as produced by shared.geocoder.normalize_query:
+    address = models.CharField(max_length=256)
+    region = models.CharField(max_length=64, blank=True, default="")
+    location = models.PointField(null=True)
+    formatted_name = models.CharField(max_length=256, blank=True, default="")
+    score = models.FloatField(null=True)
+    properties = JSONField(default=dict)
+    provider = models.CharField(max_length=20)
+    created = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        unique_together = (("address", "region"),)
+
+    def __str__(self):
+        return f"{self.address} ({self.region})"
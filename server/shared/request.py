@@ -1,16 +1,116 @@
 from django.contrib import messages
+from django.contrib.gis.geos import GEOSGeometry
+from django.contrib.gis.measure import Distance
 from django.urls import reverse
 from django.core.serializers.json import DjangoJSONEncoder
-from django.http import JsonResponse, HttpResponse
+from django.db.models.query import QuerySet
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import redirect, render_to_response, render
 
+from collections.abc import Iterator
+from itertools import chain
 import logging
 import json
 import re
 
+try:
+    # Optional. Several times faster than the standard library encoder.
+    import orjson
+except ImportError:
+    orjson = None
+
 logger = logging.getLogger("logger")
 
 
+class JSONEncoder(DjangoJSONEncoder):
+    """Extends DjangoJSONEncoder (which handles datetimes, Decimals, and UUIDs)
+    with support for geometries, distances, and iterables.
+    """
+    def default(self, o):
+        if isinstance(o, GEOSGeometry):
+            return {"type": o.geom_type, "coordinates": o.coords}
+        if isinstance(o, Distance):
+            return o.m
+        if isinstance(o, (Iterator, QuerySet)):
+            return list(o)
+        return super().default(o)
+
+
+# Reuse a single encoder. encode() uses the C implementation of the standard
+# library encoder when it is available.
+ENCODER = JSONEncoder(separators=(",", ":"))
+
+# Datetimes are passed to JSONEncoder.default, so that they are formatted the
+# same way whichever encoder is used:
+ORJSON_OPTIONS = orjson and orjson.OPT_PASSTHROUGH_DATETIME
+
+# Characters of a streamed response to encode before the response is returned:
+STREAM_BUFFER_SIZE = 8192
+
+# Appended to a streamed response when an error interrupts it:
+STREAM_ERROR_MARKER = "\n" + ENCODER.encode(
+    {"error": "The response could not be completed"})
+
+
+def encode_json(data):
+    """Encodes `data` with orjson if it is installed, falling back to
+    JSONEncoder for data that orjson can't encode, such as dicts with
+    non-string keys.
+    """
+    if orjson:
+        try:
+            return orjson.dumps(data, default=ENCODER.default,
+                                option=ORJSON_OPTIONS).decode("utf-8")
+        except TypeError:
+            pass
+    return ENCODER.encode(data)
+
+
+def iter_json(data):
+    """Yields the JSON encoding of `data` in pieces. Dicts are streamed entry by
+    entry, and lists, generators, and querysets are streamed item by item, so
+    that a generator of results does not have to be held in memory at once.
+    """
+    if isinstance(data, dict):
+        yield "{"
+        for i, (k, v) in enumerate(data.items()):
+            yield ("," if i else "") + ENCODER.encode(str(k)) + ":"
+            yield from iter_json(v)
+        yield "}"
+    elif isinstance(data, (list, tuple, Iterator, QuerySet)):
+        yield "["
+        for i, item in enumerate(data):
+            yield ("," if i else "") + encode_json(item)
+        yield "]"
+    else:
+        yield encode_json(data)
+
+
+def guard_stream(pieces):
+    try:
+        yield from pieces
+    except Exception:
+        logger.exception("Error while streaming a response")
+        yield STREAM_ERROR_MARKER
+
+
+def stream_body(pieces):
+    """Encodes the first STREAM_BUFFER_SIZE characters of a streamed response
+    before it is returned. Errors raised early, such as by the query that
+    produces the results, are then raised by the view rather than after a 200
+    status has been sent. Later errors are logged and end the response with
+    STREAM_ERROR_MARKER, so that it cannot be mistaken for a complete document.
+    """
+    pieces = iter(pieces)
+    first, size = [], 0
+    for piece in pieces:
+        first.append(piece)
+        size += len(piece)
+        if size >= STREAM_BUFFER_SIZE:
+            break
+    return chain(["".join(first)], guard_stream(pieces))
+
+
 class ErrorResponse(Exception):
     def __init__(self, message, data=None, status=401, err=None,
                  redirect_back=None):
@@ -24,13 +124,16 @@ class ErrorResponse(Exception):
 
 
 def make_response(template=None, error_template="error.djhtml",
-                  shared_context=None, redirect_back=False):
+                  shared_context=None, redirect_back=False, stream=False):
     """
     View decorator
 
     Tailor the response to the requested data type, as specified
     in the Accept header. Expects the wrapped view to return a
     dict. If the request wants JSON, renders the dict as JSON data.
+
+    If `stream` is True, JSON responses are encoded incrementally as they are
+    sent, and values in the dict may be generators.
     """
     def constructor_fn(view):
         def wrapped_view(req, *args, **kwargs):
@@ -56,11 +159,14 @@ def make_response(template=None, error_template="error.djhtml",
             jsonp_callback = req.GET.get("callback")
 
             if jsonp_callback:
-                content = json.dumps(data, cls=DjangoJSONEncoder)
-                body = "{callback}({json})".format(callback=jsonp_callback,
-                                                   json=content)
-
-                response = HttpResponse(body, status=status)
+                if stream:
+                    body = chain([f"{jsonp_callback}("], iter_json(data), [")"])
+                    response = StreamingHttpResponse(stream_body(body),
+                                                     status=status)
+                else:
+                    body = "{callback}({json})".format(callback=jsonp_callback,
+                                                       json=encode_json(data))
+                    response = HttpResponse(body, status=status)
                 response["Content-type"] = "application/javascript"
                 return response
 
@@ -69,7 +175,14 @@ def make_response(template=None, error_template="error.djhtml",
             if not use_template \
                or re.search(r"application/json", accepts) \
                or req.GET.get("format", "").lower() == "json":
-                response = JsonResponse(data, status=status)
+                if stream:
+                    response = StreamingHttpResponse(
+                        stream_body(iter_json(data)), status=status,
+                        content_type="application/json")
+                else:
+                    response = HttpResponse(
+                        encode_json(data), status=status,
+                        content_type="application/json")
                 response["Access-Control-Allow-Origin"] = "*"
                 return response
 
@@ -90,8 +203,7 @@ def make_response(template=None, error_template="error.djhtml",
 
 def json_view(view):
     def json_handler(req, *args, **kwargs):
-        resp = HttpResponse(json.dumps(view(req, *args, **kwargs),
-                                       cls=DjangoJSONEncoder))
+        resp = HttpResponse(encode_json(view(req, *args, **kwargs)))
         resp["Content-type"] = "application/json"
         return resp
 
@@ -18,7 +18,7 @@ from user.models import Subscription
 from user.mail import updates_context
 
 from .admin import cornerwise_admin
-from .geocoder import Geocoder
+from .geocoder import reverse_geocode_address
 from .mail import render_email_body
 from .widgets import DistanceWidget, DistanceField
 
@@ -68,11 +68,8 @@ class SubscriptionPreviewForm(forms.Form):
             self.add_error("start", ValidationError("start should be less than end"))
             self.add_error("end", ValidationError("end should be greater than start"))
 
-        try:
-            center = cleaned["center"]
-            cleaned["address"] = Geocoder.reverse_geocode(center.y, center.x).split(",")[0]
-        except:
-            cleaned["address"] = None
+        center = cleaned.get("center")
+        cleaned["address"] = center and reverse_geocode_address(center)
 
         return cleaned
 
@@ -1,10 +1,27 @@
 from django.test import Client, TestCase, tag, override_settings
 
 from django.contrib.auth import get_user_model
+from django.contrib.gis.geos import Point
+
+from datetime import datetime
+from decimal import Decimal
+import hashlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import io
+import json
+from socketserver import ThreadingMixIn
+import os
+import tempfile
+import threading
+from urllib.parse import parse_qs, urlparse
 
 from user.models import Subscription, UserProfile
 
-from .geocoder import Geocoder
+from . import files
+from .geocoder import CachingGeocoder, Geocoder
+from scripts import batching, download, gmaps
+from . import request
+from .request import encode_json, iter_json
 from .staff_notifications import UserNotificationForm
 import utils
 
@@ -73,3 +90,272 @@ class UtilitiesTests(TestCase):
                 .startswith("http://localhost:4000/hello"))
             self.assertEqual(utils.make_absolute_url("http://google.com"),
                              "http://google.com")
+
+    def test_iter_json_items(self):
+        doc = {"cases": [{"case_number": str(i)} for i in range(5)],
+               "events": [1, 22, 333]}
+        text = json.dumps(doc, indent=2)
+        expected = [("cases", case) for case in doc["cases"]] + \
+                   [("events", n) for n in doc["events"]]
+        for chunksize in [1, 7, len(text)]:
+            self.assertEqual(
+                list(utils.iter_json_items(io.StringIO(text), chunksize)),
+                expected)
+
+        self.assertEqual(
+            list(utils.batch_items(iter(expected), 2)),
+            [("cases", doc["cases"][0:2]), ("cases", doc["cases"][2:4]),
+             ("cases", doc["cases"][4:]), ("events", [1, 22]),
+             ("events", [333])])
+
+    def test_iter_json_numbers(self):
+        # Numbers split across chunks, e.g., after "." or "e":
+        text = '{"values": [1.5, -2, 3e2, 4.25E-1, 10, true, null], "n": 7}'
+        for chunksize in [1, 2, 3]:
+            self.assertEqual(
+                [v for _, v in utils.iter_json_items(io.StringIO(text),
+                                                     chunksize)],
+                [1.5, -2, 300.0, 0.425, 10, True, None])
+
+    def test_deadline_reader(self):
+        data = b'{"cases": []}'
+        reader = io.BufferedReader(utils.DeadlineReader(io.BytesIO(data), 60))
+        self.assertEqual(reader.read(), data)
+
+        reader = io.BufferedReader(utils.DeadlineReader(io.BytesIO(data), -1))
+        with self.assertRaises(TimeoutError):
+            reader.read()
+
+    def test_page_ranges(self):
+        self.assertEqual(files.page_ranges(45, 20),
+                         [(1, 20), (21, 40), (41, 45)])
+        self.assertEqual(files.page_ranges(20, 20), [(1, 20)])
+        self.assertEqual(files.page_ranges(0, 20), [])
+
+
+@tag("utils")
+class JSONEncodingTests(TestCase):
+    def test_streaming_matches_encode(self):
+        data = {"when": datetime(2018, 5, 1, 12, 30),
+                "amount": Decimal("10.50"),
+                "location": Point(-71.1, 42.4, srid=4326),
+                "items": [{"id": i} for i in range(3)]}
+        encoded = json.loads(encode_json(data))
+        self.assertEqual(encoded["location"],
+                         {"type": "Point", "coordinates": [-71.1, 42.4]})
+        self.assertEqual(json.loads("".join(iter_json(data))), encoded)
+
+        streamed = {"items": ({"id": i} for i in range(3))}
+        self.assertEqual(json.loads("".join(iter_json(streamed))),
+                         {"items": [{"id": 0}, {"id": 1}, {"id": 2}]})
+
+    def test_stream_errors(self):
+        def failing_items(count):
+            for i in range(count):
+                yield {"id": i}
+            raise ValueError("Query failed")
+
+        # Errors before the first chunk is sent are raised immediately:
+        with self.assertRaises(ValueError):
+            request.stream_body(iter_json({"items": failing_items(1)}))
+
+        # ...and later errors are logged and end the response with a marker:
+        body = request.stream_body(iter_json({"items": failing_items(5000)}))
+        with self.assertLogs("logger", "ERROR"):
+            streamed = "".join(body)
+        self.assertTrue(streamed.endswith(request.STREAM_ERROR_MARKER))
+
+
+@tag("geocoder")
+class GeocodeCacheTests(TestCase):
+    def test_cached_geocode(self):
+        calls = []
+
+        class StubGeocoder(object):
+            def geocode(self, addrs, **kwargs):
+                calls.append(list(addrs))
+                return [None if "Nowhere" in addr else
+                        {"location": {"lat": 42.4, "lng": -71.1},
+                         "formatted_name": addr.upper(),
+                         "properties": {"score": 90}}
+                        for addr in addrs]
+
+        geocoder = CachingGeocoder(StubGeocoder(), "stub")
+        first = geocoder.geocode(["1 Main Street", "2 Nowhere Rd"],
+                                 region="Somerville, MA")
+        self.assertIsNone(first[1])
+        second = geocoder.geocode(["1 MAIN ST.", "2 Nowhere Road"],
+                                  region="Somerville, MA")
+        self.assertEqual(second, first)
+        self.assertEqual(calls, [["1 Main Street", "2 Nowhere Rd"]])
+
+        geocoder.geocode(["1 Main Street"], region="Cambridge, MA")
+        self.assertEqual(len(calls), 2)
+
+    def test_failures_not_cached(self):
+        calls = []
+
+        class FailingGeocoder(object):
+            def geocode(self, addrs, **kwargs):
+                calls.append(list(addrs))
+                return [batching.FAILED for _ in addrs]
+
+        geocoder = CachingGeocoder(FailingGeocoder(), "stub")
+        self.assertFalse(geocoder.geocode(["1 Main Street"])[0])
+        geocoder.geocode(["1 Main Street"])
+        self.assertEqual(len(calls), 2)
+
+
+class StubGeocodeHandler(BaseHTTPRequestHandler):
+    """Responds like the Google geocoding API, failing the first request for
+    each address with a server error. Requests for addresses on Broken Street
+    always fail.
+    """
+    failed = set()
+
+    def do_GET(self):
+        address = parse_qs(urlparse(self.path).query)["address"][0]
+        if address not in self.failed or "Broken" in address:
+            self.failed.add(address)
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        number = int(address.split()[0])
+        body = json.dumps({"status": "OK", "results": [{
+            "geometry": {"location": {"lat": 42 + number/1000, "lng": -71}},
+            "formatted_address": address,
+            "place_id": str(number),
+            "types": ["street_address"]}]})
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(body.encode("utf-8"))
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@tag("geocoder")
+class BatchGeocodeTests(TestCase):
+    def setUp(self):
+        self.server = StubServer(("127.0.0.1", 0), StubGeocodeHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_batch_geocode(self):
+        host, port = self.server.server_address
+        geocoder = gmaps.GoogleGeocoder("key", url=f"http://{host}:{port}/",
+                                        concurrency=8, rate=100, backoff=0.01)
+        addrs = [f"{n} Highland Ave" for n in range(50)]
+        results = geocoder.geocode(addrs)
+        self.assertEqual([r["formatted_name"] for r in results], addrs)
+        self.assertEqual([r["properties"]["place_id"] for r in results],
+                         [str(n) for n in range(50)])
+
+    def test_failed_requests(self):
+        host, port = self.server.server_address
+        geocoder = gmaps.GoogleGeocoder("key", url=f"http://{host}:{port}/",
+                                        concurrency=4, rate=100, backoff=0.01)
+        results = geocoder.geocode(["1 Highland Ave", "2 Broken St",
+                                    "3 Highland Ave"])
+        self.assertIs(results[1], batching.FAILED)
+        self.assertEqual([results[0]["formatted_name"],
+                          results[2]["formatted_name"]],
+                         ["1 Highland Ave", "3 Highland Ave"])
+
+
+class StubDocumentHandler(BaseHTTPRequestHandler):
+    """Serves a document with an ETag, supporting conditional and range
+    requests.
+    """
+    body = bytes(range(256)) * 64
+    etag = '"v1"'
+    requests = []
+
+    def send_headers(self, status, length):
+        self.send_response(status)
+        self.send_header("ETag", self.etag)
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.requests.append(("HEAD", dict(self.headers)))
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_headers(304, 0)
+        else:
+            self.send_headers(200, len(self.body))
+
+    def do_GET(self):
+        self.requests.append(("GET", dict(self.headers)))
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_headers(304, 0)
+            return
+
+        range_header = self.headers.get("Range")
+        if range_header and self.headers.get("If-Range") == self.etag:
+            start = int(range_header[len("bytes="):-1])
+            self.send_headers(206, len(self.body) - start)
+            self.wfile.write(self.body[start:])
+        else:
+            self.send_headers(200, len(self.body))
+            self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+@tag("documents")
+class DownloadClientTests(TestCase):
+    def setUp(self):
+        StubDocumentHandler.requests = []
+        self.server = StubServer(("127.0.0.1", 0), StubDocumentHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        host, port = self.server.server_address
+        self.url = f"http://{host}:{port}/plans.pdf"
+        self.dest = os.path.join(tempfile.mkdtemp(), "plans.pdf.part")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        download.remove(self.dest, self.dest + ".meta")
+
+    def test_conditional(self):
+        client = download.DownloadClient()
+        dl = client.fetch(self.url, self.dest)
+        self.assertEqual(dl.status, 200)
+        self.assertEqual(dl.etag, StubDocumentHandler.etag)
+        self.assertEqual(dl.size, len(StubDocumentHandler.body))
+
+        self.assertIs(client.head(self.url, dl.etag), False)
+        self.assertIs(client.head(self.url, '"v0"'), True)
+        self.assertTrue(client.fetch(self.url, self.dest, dl.etag).not_modified)
+
+    def test_resume(self):
+        body = StubDocumentHandler.body
+        with open(self.dest, "wb") as partial:
+            partial.write(body[0:1000])
+        with open(self.dest + ".meta", "w") as meta:
+            json.dump({"url": self.url,
+                       "validator": StubDocumentHandler.etag}, meta)
+
+        dl = download.DownloadClient().fetch(self.url, self.dest)
+        self.assertEqual(dl.status, 206)
+        self.assertEqual(StubDocumentHandler.requests[-1][1]["Range"],
+                         "bytes=1000-")
+        with open(self.dest, "rb") as downloaded:
+            self.assertEqual(downloaded.read(), body)
+        self.assertEqual(dl.digest, hashlib.sha256(body).hexdigest())
+
+    def test_max_size(self):
+        client = download.DownloadClient(max_size=100)
+        with self.assertRaises(download.DownloadTooLarge):
+            client.fetch(self.url, self.dest)
+        self.assertFalse(os.path.exists(self.dest))
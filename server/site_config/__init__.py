@@ -56,6 +56,12 @@ def by_name(name: str) -> SiteConfig:
     return NAMES.get(name.lower())
 
 
+def by_region_name(region_name: str) -> SiteConfig:
+    region_name = region_name.lower()
+    return next((config for config in NAMES.values()
+                 if config.region_name.lower() == region_name), None)
+
+
 def base_url(site_name):
     return site_config(site_name).hostname
 
@@ -3,7 +3,7 @@ from collections import defaultdict, OrderedDict
 from django.forms.models import model_to_dict
 
 from proposal.models import Changeset, Document, Image, Proposal, Event
-from proposal.views import proposal_json
+from proposal.views import proposals_json
 from proposal.query import build_proposal_query_dict
 
 
@@ -39,11 +39,11 @@ def summarize_query_updates(query_dict, since=None, until=None):
         proposals_changed = proposals_changed.filter(updated__lte=until)
 
     # Start with the new proposals:
-    summary = OrderedDict((p.id, {
-        "proposal": proposal_json(
-            p, include_images=1, include_documents=False),
+    summary = OrderedDict((p["id"], {
+        "proposal": p,
         "new": True
-    }) for p in proposals)
+    }) for p in proposals_json(proposals, include_images=1,
+                               include_documents=False))
 
     if proposals_changed:
         # Only include changesets for proposals we're interested in:
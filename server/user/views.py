@@ -15,6 +15,7 @@ import logging
 
 import pytz
 
+from shared.geocoder import reverse_geocode_address
 from shared.request import make_response, make_message, ErrorResponse, redirect_back
 from shared.mail import render_email_body
 from user import tasks
@@ -71,6 +72,9 @@ def subscribe(request):
                                     address=request.POST.get("address", ""))
         subscription.set_validated_query(query_dict)
         subscription.user = user
+        if not subscription.address and subscription.center:
+            subscription.address = \
+                (reverse_geocode_address(subscription.center) or "")[0:64]
 
         subscription.save()
     except (ValidationError, ValueError) as exc:
@@ -1,9 +1,13 @@
 from datetime import datetime, timedelta
+import io
 import json
 import os
 import re
 import pytz
+import time
 from collections import deque
+from itertools import groupby
+from operator import itemgetter
 import typing
 from urllib import parse, request
 
@@ -291,6 +295,139 @@ def read_n_from_end(fp: typing.IO, n,
     return lines
 
 
+class DeadlineReader(io.RawIOBase):
+    """Wraps a binary stream, such as an HTTP response, raising TimeoutError if
+    it is read after the deadline. A socket timeout limits each read, but not
+    the total time spent reading a response that arrives slowly.
+    """
+    def __init__(self, fp, timeout):
+        """
+        :param fp: a binary stream with a readinto method
+        :param timeout: seconds from now after which reads fail
+        """
+        self.fp = fp
+        self.deadline = time.monotonic() + timeout
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if time.monotonic() > self.deadline:
+            raise TimeoutError("Deadline exceeded while reading")
+        return self.fp.readinto(b)
+
+
+JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# Characters that may continue a number:
+JSON_NUMBER_TAIL = re.compile(r"[-+0-9.eE]*")
+JSON_DECODER = json.JSONDecoder()
+
+
+class JSONStream(object):
+    """Helper for incrementally decoding JSON from a text stream. Only the
+    unconsumed portion of the input is kept in memory.
+    """
+    def __init__(self, fp, chunksize):
+        self.fp = fp
+        self.chunksize = chunksize
+        self.buff = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        if self.eof:
+            return False
+        chunk = self.fp.read(self.chunksize)
+        self.buff = self.buff[self.pos:] + chunk
+        self.pos = 0
+        self.eof = not chunk
+        return not self.eof
+
+    def peek(self):
+        "Skips whitespace and returns the next character, or '' at the end."
+        while True:
+            self.pos = JSON_WHITESPACE.match(self.buff, self.pos).end()
+            if self.pos < len(self.buff):
+                return self.buff[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, chars):
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError(f"Expected one of {chars!r} at {self.pos}, "
+                             f"found {c!r}")
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                val, end = JSON_DECODER.raw_decode(self.buff, self.pos)
+                # A number may continue in the next chunk, e.g., "1." + "5",
+                # so wait until something other than a number follows it:
+                if self.eof or \
+                   JSON_NUMBER_TAIL.match(self.buff, end).end() < len(self.buff):
+                    self.pos = end
+                    return val
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+def iter_json_items(fp: typing.TextIO, chunksize=65536):
+    """Incrementally parses a JSON object whose values are arrays, such as an
+    importer response, without reading the whole document into memory.
+
+    :param fp: a text stream
+    :param chunksize: number of characters to read at a time
+
+    :returns: a generator of (key, item) pairs, one for each item of each
+    array, in document order. Values that are not arrays are skipped.
+    """
+    stream = JSONStream(fp, chunksize)
+    stream.expect("{")
+    if stream.peek() == "}":
+        return
+
+    while True:
+        key = stream.value()
+        stream.expect(":")
+        if stream.peek() == "[":
+            stream.pos += 1
+            if stream.peek() == "]":
+                stream.pos += 1
+            else:
+                while True:
+                    yield key, stream.value()
+                    if stream.expect(",]") == "]":
+                        break
+        else:
+            stream.value()
+
+        if stream.expect(",}") == "}":
+            break
+
+
+def batch_items(pairs, size):
+    """Groups consecutive (key, item) pairs that share a key into lists of at
+    most `size` items.
+
+    :returns: a generator of (key, items) pairs
+    """
+    for key, group in groupby(pairs, itemgetter(0)):
+        batch = []
+        for _, item in group:
+            batch.append(item)
+            if len(batch) >= size:
+                yield key, batch
+                batch = []
+        if batch:
+            yield key, batch
+
+
 def make_absolute_url(path, site_name=None):
     if re.match(r"^https?://", path):
         return path